@@ -0,0 +1,118 @@
+import pandas as pd
+from sqlalchemy import bindparam, text
+from pick import pick_sql
+
+# the baseline tables of the GGO cohort before dx, built in one batch from one
+# filtered scan of notes_ggo (_baseline_notes). Each spec is a dict:
+# * name: the table name
+# * level1: the ggo_level1 of the records
+# * columns: the columns of the table as {name: sql expression}, over
+#   ggo_date, ggo_level2, ggo_level3 and dx_date; {'cat': 'ggo_level2'} by default
+# * where: an additional sql condition on the records, if any
+# * tiebreak: the order of the records within a date, see pick.pick_sql
+# * pick: 'first' (default) or 'last' record before dx
+# * exclusive: only keep the dates with a single distinct cat
+case_days = """case when days_ggo_before_dx<180 then '<6M'
+            when days_ggo_before_dx<365 then '6M-1y'
+            when days_ggo_before_dx<365*3 then '1-3y'
+            else '>=3y'
+            end """
+
+status_change_case = """case ggo_level2
+    when 'resolved/disappeared' then '01.resolved'
+    when 'decreased/improved/reduced/shrink' then '02.decreased'
+    when 'stable/no change/persistent' then '03.stable'
+    when 'increased/progressed' then '04.increased'
+    end"""
+
+potential_cause_case = """case ggo_level2
+    when 'infectious_inflammatory' then '02.infect/inflam'
+    when 'other' then '01.other'
+    when 'malignant neoplasm' then '04.malignant'
+    when 'premalignancy' then '03.premalig'
+    end"""
+
+baseline_specs = [
+    dict(name='baseline_size_cat', level1='GGO_size',
+         columns={'size_cat': 'ggo_level2', 'size': 'cast(ggo_level3 as float)'},
+         tiebreak=['size desc']),
+    dict(name='baseline_number_cat', level1='GGO_number', tiebreak=['cat desc']),
+    dict(name='baseline_ex_location_uml', level1='GGO_location',
+         columns={'cat': "concat(ggo_level2, ':', ggo_level3)"},
+         where="ifnull(ggo_level3, 'other') != 'other'",
+         tiebreak=['cat'], exclusive=True),
+    dict(name='last_status_cat', level1='GGO_status_change',
+         columns={'cat': status_change_case}, where="ifnull(ggo_level2, '') != ''",
+         tiebreak=['cat desc']),
+    dict(name='first_potential_cause_cat', level1='GGO_potential_cause',
+         columns={'cat': potential_cause_case}, where="ifnull(ggo_level2, '') != ''",
+         tiebreak=['cat desc']),
+]
+
+notes_sql = """\
+select d_person_id, note_date ggo_date, ggo_level1, ggo_level2, ggo_level3, dx_date
+from _cohort_ggo_before_dx
+join notes_ggo using (d_person_id)
+join _lca_dx using (d_person_id)
+where ggo_level1 in :level1s
+    and note_date <= dx_date"""
+
+def baseline_source_sql(spec, param):
+    """return the subquery of the records of a spec in _baseline_notes, with
+    its level1 bound to :{param}."""
+    columns = spec.get('columns', {'cat': 'ggo_level2'})
+    where = f"\n        and {spec['where']}" if spec.get('where') else ''
+    values = ''.join(f', {expr} {name}' for name, expr in columns.items())
+    records = f"""select distinct d_person_id, ggo_date{values}
+        from _baseline_notes
+        where ggo_level1 = :{param}{where}"""
+    if spec.get('exclusive'):
+        records = f"""select d_person_id, ggo_date, min(cat) cat
+        from ({records}) as records
+        group by d_person_id, ggo_date
+        having count(distinct cat) = 1"""
+    return f'({records}) as src'
+
+def baseline_table_sql(spec, param):
+    """return the sql of the baseline table of a spec: the picked record of
+    each patient, with days_ggo_before_dx and date_cat."""
+    columns = list(spec.get('columns', {'cat': 'ggo_level2'}))
+    pick = spec.get('pick', 'first')
+    picked = pick_sql(baseline_source_sql(spec, param), columns,
+                      tiebreak=spec.get('tiebreak', ()), picks=[pick])
+    values = ''.join(f', {pick}_{c} {c}' for c in columns)
+    return f"""\
+select *, {case_days} as date_cat
+from (
+    select d_person_id, {pick}_ggo_date ggo_date{values}
+    , dx_date, dx_year, dx_date-{pick}_ggo_date days_ggo_before_dx
+    from ({picked}) as picked
+    join _lca_dx using (d_person_id)
+) as raw"""
+
+def build_baselines(connection, specs=baseline_specs):
+    """(re)build the baseline table of each spec from one scan of notes_ggo.
+
+    return the qc counts of each table: records, days and patients.
+    """
+    level1s = sorted({spec['level1'] for spec in specs})
+    sqls = [(text("drop table if exists _baseline_notes"), {}),
+            (text(f"create table _baseline_notes as\n{notes_sql}")
+             .bindparams(bindparam('level1s', expanding=True)), dict(level1s=level1s)),
+            (text("create index ix__baseline_notes on _baseline_notes (ggo_level1, d_person_id)"), {})]
+    for i, spec in enumerate(specs):
+        sqls += [(text(f"drop table if exists {spec['name']}"), {}),
+                 (text(f"create table {spec['name']} as\n{baseline_table_sql(spec, f'level1_{i}')}"),
+                  {f'level1_{i}': spec['level1']})]
+    for sql, params in sqls:
+        connection.execute(sql, params)
+    return baseline_qc(connection, specs)
+
+def baseline_qc(connection, specs=baseline_specs):
+    """return the qc counts of each baseline table: records, days and patients."""
+    qc = '\nunion all\n'.join(
+        f"""select '{spec['name']}' as tablename, count(*) as records
+        , count(distinct concat(d_person_id, ':', ggo_date)) as days
+        , count(distinct d_person_id) as patients
+        from {spec['name']}""" for spec in specs)
+    return pd.read_sql(text(qc), connection, index_col='tablename')
@@ -0,0 +1,173 @@
+import os, subprocess, time
+from pathlib import Path
+import pandas as pd
+from sqlalchemy import create_engine, event, text
+from synth import synthetic_ehr, load_tables
+from util import (create_table_sql, level_person_sql, level_person_sets, level_patient_counts,
+                  persistent_cohort_sql, notes_ggo_summary_sql)
+from cohort import lca_cohort_sql, lca_dx_sql
+from pipeline import lca_range_sql, cohort_ggo_before_dx_sql
+from span import span_sources, source_span_sql, event_span_sql
+from baseline import build_baselines
+from followup import followup_long
+from sankey import sankey_from_person_cat_rnk
+
+# the scaling benchmark of the analysis stages on synthetic data, e.g.
+# run_benchmark([10000, 100000, 1000000], 'bench') for the curves of the
+# current commit, appended to bench/results.csv to compare before and after a change.
+# The sql stages run on sqlite by default, or any url, e.g. 'duckdb:///{path}'
+# (with duckdb_engine) or a mysql test database; a stage using sql the
+# database does not support is reported with its error.
+
+def _execute(connection, sqls):
+    for sql in sqls:
+        connection.execute(text(sql))
+
+def stage_lca_cohort(connection):
+    # the view of cohort.build_lca_cohort, without its create or replace (not in sqlite)
+    _execute(connection, create_table_sql('s4_lca_cohort', lca_cohort_sql(), index=['d_person_id'])
+             + ["drop view if exists v_s4_lca_cohort",
+                "create view v_s4_lca_cohort as select d_person_id, cohort from s4_lca_cohort"])
+
+def stage_lca_dx(connection):
+    _execute(connection, create_table_sql('_lca_dx', lca_dx_sql(), index=['d_person_id']))
+
+def stage_event_span(connection):
+    for source in span_sources:
+        _execute(connection, create_table_sql(f'_span_{source}', source_span_sql(source),
+                                              index=['d_person_id']))
+    _execute(connection, create_table_sql('s4_person_event_span', event_span_sql(),
+                                          index=['d_person_id']))
+
+def stage_lca_range(connection):
+    _execute(connection, create_table_sql('_lca_range', lca_range_sql))
+
+def stage_followup(connection):
+    followup_long(pd.read_sql(text('select * from _lca_range'), connection))
+
+def stage_baselines(connection):
+    _execute(connection, create_table_sql('_cohort_ggo_before_dx', cohort_ggo_before_dx_sql,
+                                          index=['d_person_id']))
+    build_baselines(connection)
+
+def stage_notes_ggo_summary(connection):
+    _execute(connection, create_table_sql('s4_persistent_cohort', persistent_cohort_sql(),
+                                          index=['d_person_id'])
+             + create_table_sql('s4_notes_ggo_summary',
+                                notes_ggo_summary_sql(persistent='s4_persistent_cohort',
+                                                      dialect=connection.dialect.name)))
+
+def stage_sankey(connection):
+    df = pd.read_sql(text("""\
+select d_person_id person_id, substr(ggo_level2, 1, 3) cat, note_date
+from notes_ggo
+where ggo_level1 = 'GGO_status_change' and ggo_level2 is not null"""), connection)
+    df = df.sort_values(['person_id', 'note_date'], kind='mergesort')
+    df['rnk'] = df.groupby('person_id').cumcount() + 1
+    sankey_from_person_cat_rnk(df[df.rnk <= 10])
+
+def stage_venn(connection):
+    sets = level_person_sets(pd.read_sql(text(level_person_sql()), connection))
+    for level1 in sets:
+        level_patient_counts(sets, level1)
+
+# in dependency order
+bench_stages = {
+    'lca_cohort': stage_lca_cohort,
+    'lca_dx': stage_lca_dx,
+    'event_span': stage_event_span,
+    'lca_range': stage_lca_range,
+    'followup': stage_followup,
+    'baselines': stage_baselines,
+    'notes_ggo_summary': stage_notes_ggo_summary,
+    'sankey': stage_sankey,
+    'venn': stage_venn,
+}
+
+def sqlite_functions(engine):
+    """add the mysql functions used by the sql of the stages to sqlite connections."""
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        def least(*args):
+            return None if None in args else min(args)
+        def greatest(*args):
+            return None if None in args else max(args)
+        def concat(*args):
+            return None if None in args else ''.join(map(str, args))
+        class sorted_concat:
+            # the sorted values joined by ', ', no order by in sqlite aggregates
+            def __init__(self):
+                self.values = []
+            def step(self, value):
+                if value is not None:
+                    self.values.append(value)
+            def finalize(self):
+                return ', '.join(map(str, sorted(self.values))) if self.values else None
+        dbapi_connection.create_function('least', -1, least, deterministic=True)
+        dbapi_connection.create_function('greatest', -1, greatest, deterministic=True)
+        dbapi_connection.create_function('concat', -1, concat, deterministic=True)
+        dbapi_connection.create_aggregate('sorted_concat', 1, sorted_concat)
+
+def current_label():
+    """return the short hash of the current commit, or 'unknown'."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(__file__)).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+def run_benchmark(scales=(10000, 100000), bench_dir='bench', url=None, stages=bench_stages,
+                  label=None, seed=0, repeat=1, reload=False):
+    """time each stage on synthetic data of each scale (number of patients).
+
+    - url: the database url, with {path} for a file in bench_dir; sqlite by default.
+    - label: the name of the run in the results, the current commit by default.
+    - reload: generate and load the data again, otherwise the sqlite file of
+      the same scale and seed is reused.
+
+    return a df of the seconds of each stage and scale (the best of repeat),
+    also appended to bench_dir/results.csv.
+    """
+    bench_dir = Path(bench_dir)
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    label = label or current_label()
+    res = []
+    for n_patients in scales:
+        path = bench_dir / f'synth_{n_patients}_{seed}.db'
+        engine = create_engine((url or 'sqlite:///{path}').format(path=path))
+        if engine.dialect.name == 'sqlite':
+            sqlite_functions(engine)
+        if reload or engine.dialect.name != 'sqlite' or not path.exists():
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                load_tables(synthetic_ehr(n_patients, seed=seed), connection)
+            res.append(dict(label=label, n_patients=n_patients, stage='load',
+                            seconds=time.perf_counter() - start, error=None))
+        for name, stage in stages.items():
+            times, error = [], None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    with engine.begin() as connection:
+                        stage(connection)
+                except Exception as e:
+                    error = str(e).splitlines()[0][:200]
+                    break
+                times.append(time.perf_counter() - start)
+            res.append(dict(label=label, n_patients=n_patients, stage=name,
+                            seconds=min(times) if times else None, error=error))
+        engine.dispose()
+    res = pd.DataFrame(res)
+    results = bench_dir / 'results.csv'
+    res.to_csv(results, mode='a', header=not results.exists(), index=False)
+    return res
+
+def scaling_curves(results, label=None):
+    """return the seconds of each stage (rows) by scale (columns) from a
+    results df or csv, for one label or each label (as the first index level)."""
+    if not isinstance(results, pd.DataFrame):
+        results = pd.read_csv(results)
+    if label is not None:
+        results = results[results.label == label]
+    return results.pivot_table(index=['label', 'stage'], columns='n_patients',
+                               values='seconds', aggfunc='min', sort=False)
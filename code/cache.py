@@ -0,0 +1,59 @@
+import hashlib, os, re
+from pathlib import Path
+import pandas as pd
+from snapshot import source_version
+
+def normalize_sql(sql):
+    """return the sql text with the comments, blanks and ending ';' removed."""
+    sql = re.sub(r'--[^\n]*', '', str(sql))
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip()
+
+def read_sql_cached(sql, connection, cache_dir, tables, stamps=None, max_bytes=2**30, index_col=None,
+                    **kwargs):
+    """pd.read_sql with a local cache of the results.
+
+    The results are stored as parquet files in cache_dir, keyed by the
+    normalized sql, the read_sql kwargs and the version of the tables the
+    query reads (see snapshot.source_version), so they are read again
+    from the database only after those tables changed.
+
+    - tables: all the tables (or views) the query reads, the derived ones too,
+      e.g. ['s4_lca_cohort', 'visits']; a view is only known from the refresh
+      log, otherwise the result is not cached.
+    - stamps: the stamps already taken, e.g. snapshot.source_stamps once per
+      session, the other tables are stamped at each call.
+
+    The least recently used results are evicted above max_bytes.
+    """
+    version = source_version(connection, tables, stamps)
+    key = '\0'.join([normalize_sql(sql), str(version), repr(sorted(kwargs.items()))])
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f'{hashlib.sha256(key.encode()).hexdigest()}.parquet'
+    if version is not None and path.exists():
+        os.utime(path)  # the mtime is the last use
+        df = pd.read_parquet(path)
+    else:
+        df = _read_sql_to_cache(sql, connection, path if version else None, max_bytes, **kwargs)
+    return df if index_col is None else df.set_index(index_col)
+
+def _read_sql_to_cache(sql, connection, path, max_bytes, **kwargs):
+    df = pd.read_sql(sql, connection, **kwargs)
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            df.to_parquet(path)
+        except ValueError:
+            # not storable as parquet, e.g. duplicated column names
+            path.unlink(missing_ok=True)
+        evict(path.parent, max_bytes)
+    return df
+
+def evict(cache_dir, max_bytes):
+    """remove the least recently used results until cache_dir fits in max_bytes."""
+    files = sorted(Path(cache_dir).glob('*.parquet'), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in files)
+    for p in files:
+        if total <= max_bytes:
+            break
+        total -= p.stat().st_size
+        p.unlink()
@@ -0,0 +1,124 @@
+import time
+import pandas as pd
+from sqlalchemy import text
+from icd import lca_icd_prefixes, prefix_where_sql
+from util import create_table_sql
+
+# the LCa cohorts, materialized in s4_lca_cohort (d_person_id, cohort,
+# n_days_with_lca_diagnosis) with v_s4_lca_cohort as a view over it:
+# * path-confirmed: cancer_type_id=1 in cancer_diagnoses
+# * likely: not path-confirmed and an LCa ICD code on >= min_days days
+# * unlikely: not path-confirmed and an LCa ICD code on < min_days days
+lca_cohort_order = ['path-confirmed', 'likely', 'unlikely']
+
+def lca_cohort_sql(min_days=3, prefixes=lca_icd_prefixes):
+    """return the sql classifying each patient in one grouped pass over the
+    confirmed diagnoses and the LCa ICD codes."""
+    return f"""\
+select d_person_id
+, case when max(confirmed) = 1 then 'path-confirmed'
+    when count(distinct lca_date) >= {min_days} then 'likely'
+    else 'unlikely' end cohort
+, count(distinct lca_date) n_days_with_lca_diagnosis
+from (
+    select d_person_id, 1 confirmed, null lca_date
+    from cancer_diagnoses where cancer_type_id = 1
+    union all
+    select d_person_id, 0 confirmed, event_date lca_date
+    from person_icd_codes
+    where {prefix_where_sql('icd_code', prefixes)}
+) as events
+group by d_person_id"""
+
+def lca_dx_sql(prefixes=lca_icd_prefixes):
+    """return the sql of the LCa dx date (and year) of each patient: the first
+    LCa diagnosis in cancer_diagnoses if any, otherwise the first LCa ICD code."""
+    return f"""\
+with first_icd as (
+    select d_person_id
+    , min(event_date) first_icd_date
+    , min(year_event_date) first_icd_year
+    from person_icd_codes
+    where {prefix_where_sql('icd_code', prefixes)}
+    group by d_person_id
+), first_confirmed as (
+    select d_person_id
+    , min(date_of_diagnosis) first_confirmed_date
+    , min(year_of_diagnosis) first_confirmed_year
+    from cancer_diagnoses
+    join cancer_types using (cancer_type_id)
+    where cancer_type_name='LCA'
+    group by d_person_id
+)
+select d_person_id
+, coalesce(first_confirmed_date, first_icd_date) dx_date
+, coalesce(first_confirmed_year, first_icd_year) dx_year
+from first_icd
+left join first_confirmed using (d_person_id)"""
+
+def lca_cohort_view_sql(min_days=3, prefixes=lca_icd_prefixes):
+    """return the sql of the former v_s4_lca_cohort view, for the benchmark."""
+    confirmed = """select distinct d_person_id
+    from cancer_diagnoses where cancer_type_id = 1"""
+    other = f"""select d_person_id, count(distinct(event_date)) as n_days_with_lca_diagnosis
+    from person_icd_codes
+    where {prefix_where_sql('icd_code', prefixes)}
+        and d_person_id not in ({confirmed})
+    group by d_person_id"""
+    return f"""\
+select d_person_id, 'path-confirmed' as cohort from ({confirmed}) as confirmed
+union all
+select d_person_id, 'likely' as cohort from ({other}) as other
+where n_days_with_lca_diagnosis >= {min_days}
+union all
+select d_person_id, 'unlikely' as cohort from ({other}) as other
+where n_days_with_lca_diagnosis < {min_days}"""
+
+def build_lca_cohort(connection, min_days=3, prefixes=lca_icd_prefixes):
+    """(re)build s4_lca_cohort, with d_person_id as primary key and an index
+    on cohort, and v_s4_lca_cohort over it.
+
+    - min_days: the number of days with an LCa ICD code of the likely cohort.
+    """
+    sqls = create_table_sql('s4_lca_cohort', lca_cohort_sql(min_days, prefixes),
+                            index=['cohort'])
+    sqls += ["alter table s4_lca_cohort add primary key (d_person_id)",
+             """create or replace view v_s4_lca_cohort as
+    select d_person_id, cohort from s4_lca_cohort"""]
+    for sql in sqls:
+        connection.execute(text(sql))
+
+# downstream joins of the cohort, {cohort} is the table or subquery timed
+benchmark_queries = {
+    'cohort_count': "select cohort, count(*) from {cohort} group by cohort",
+    'lca_range': """select cohort, count(*), min(first_event_date), max(last_event_date)
+        from {cohort} join _lca_dx using (d_person_id)
+        left join s4_person_event_span using (d_person_id)
+        group by cohort""",
+    'patient_ggo': """select cohort, count(distinct d_person_id)
+        from {cohort} join notes_ggo using (d_person_id)
+        group by cohort""",
+}
+
+def benchmark_lca_cohort(connection, min_days=3, queries=benchmark_queries, repeat=3):
+    """time the downstream queries joined to the former view and to s4_lca_cohort,
+    which must be built with the same min_days.
+
+    return a df of the best seconds of each query, with the speedup.
+    """
+    sources = {'view': f'({lca_cohort_view_sql(min_days)}) as c',
+               'table': 's4_lca_cohort'}
+    res = []
+    for name, query in queries.items():
+        row = dict(query=name)
+        for source, cohort in sources.items():
+            sql = text(query.format(cohort=cohort))
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(sql).fetchall()
+                times.append(time.perf_counter() - start)
+            row[source] = min(times)
+        res.append(row)
+    res = pd.DataFrame(res).set_index('query')
+    return res.assign(speedup=res['view'] / res['table'])
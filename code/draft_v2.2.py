@@ -38,8 +38,42 @@ db_url = f'mysql+pymysql://{db_user}:{db_password}@{db_host}:3306/{db_name}'
 # %%
 #connect to database
 engine = create_engine(db_url)
+# the time, rows and bytes of every statement, see the query report at the end
+from querylog import instrument, query_report
+query_records = instrument(engine)
 connection = engine.connect().execution_options(autocommit=True)
 
+
+# %%
+# local parquet snapshot of the source tables, pulled once per database refresh
+# and read by the analyses in pandas below (2.g, 2.h); None if the version of
+# the tables is unknown, then they are read from the database; the stamps of
+# the source tables are taken once for the session and reused below
+from snapshot import take_snapshot, read_snapshot, source_stamps
+session_stamps = source_stamps(connection)
+snapshot_dir = working_dir/'snapshot'
+snapshot_path = take_snapshot(connection, snapshot_dir, stamps=session_stamps)
+
+
+# %%
+# local cache of the query results, until the tables they read change (their
+# stamps: the refresh log and the table status, see snapshot.table_stamps;
+# log_refresh the source tables after a database refresh)
+from cache import read_sql_cached
+cache_dir = working_dir/'cache'
+
+
+# %%
+# the analysis tables built as stages, see pipeline.py: the independent stages
+# run concurrently, and the stages whose inputs did not change since the last
+# run are skipped; the sections below read the tables.
+from stages import run_stages
+from pipeline import pipeline_stages, lca_range_sql, cohort_ggo_before_dx_sql, patient_ggo_sql
+lca_min_days = 3
+stage_report = run_stages(engine, pipeline_stages(lca_min_days), f'{working_dir}/stages.json',
+                          stamps=session_stamps)
+stage_report
+
 # %% [markdown]
 # ## I. Base study population
 # Request:
@@ -82,34 +116,16 @@ connection = engine.connect().execution_options(autocommit=True)
 # * Then exclude the patients with LCa diagnosis (first path-confirmed report if available, otherwise first ICD report) reported earlier than 2003 or later than 2020. 
 # 
 # Results: 
-# * The cohort info can be found in the view: v_s4_lca_cohort 
+# * The cohort info can be found in the view: v_s4_lca_cohort (materialized in the table s4_lca_cohort)
 # 
 # ### 1.b Sample count of sub cohorts (cohorts are mutually exclusive)
 # Summary:
 
 # %%
-confirmed = """SELECT distinct d_person_id 
-    FROM cancer_diagnoses where cancer_type_id = 1
-    """
-other = f"""SELECT d_person_id, count(distinct(event_date)) as n_days_with_lca_diagnosis
-    FROM person_icd_codes 
-    where (icd_code like 'C34%' or icd_code like '162%')
-        and d_person_id not in ({confirmed})
-    GROUP BY d_person_id
-    """
-select = f"""SELECT d_person_id, 'path-confirmed' as cohort 
-    FROM ({confirmed}) as confirmed
-    UNION ALL
-    SELECT d_person_id, 'likely' as cohort 
-    FROM ({other}) as other
-    where n_days_with_lca_diagnosis >= 3 
-    UNION ALL
-    SELECT d_person_id, 'unlikely' as cohort
-    FROM ({other}) as other
-    where n_days_with_lca_diagnosis < 3
-    """
-tmp = connection.execute(text(f"""create or replace view v_s4_lca_cohort as
-    {select}"""))
+from icd import prefix_where_sql, prefix_patient_counts
+# the cohorts are classified in one grouped pass and materialized in the
+# indexed table s4_lca_cohort (the lca_cohort stage); v_s4_lca_cohort is a view over it.
+from cohort import benchmark_lca_cohort
 
 
 # %%
@@ -130,16 +146,15 @@ pd.read_sql("select cohort, count(*) patients from v_s4_lca_cohort group by coho
 # Summary:
 
 # %%
-tmp=connection.execute(text(r"""
-    create or replace view _ct_chest as
-    select * from radiologies
-    where imaging_study like '%CT%' and location like '%Chest%'
-    """))
+# the radiology reports are tagged once with a modality and body site code in
+# s4_radiology_class (indexed, the radiology_class stage), _ct_chest is a view
+# of its CT/chest rows.
 
 
 # %%
 cohort_order=['path-confirmed', 'likely', 'unlikely']
 describe_order = ['mean', 'min', '25%', '50%', '75%', 'max']
+from followup import followup_type_order, followup_long, followup_summary
 
 
 # %%
@@ -164,162 +179,102 @@ data.groupby('cohort')['ct_scans'].describe()    .loc[cohort_order, describe_ord
 # Summary: 
 
 # %%
-sql = r"""
-with first_icd as (
-    select d_person_id
-    , min(event_date) first_icd_date
-    , min(year_event_date) first_icd_year
-    from person_icd_codes
-    where (icd_code like 'C34%' or icd_code like '162%')
-    group by d_person_id
-), first_confirmed as (
-    select d_person_id
-    , min(date_of_diagnosis) first_confirmed_date
-    , min(year_of_diagnosis) first_confirmed_year
-    from cancer_diagnoses
-    join cancer_types using (cancer_type_id)
-    where cancer_type_name='LCA'
-    group by d_person_id
-)
-select d_person_id
-, coalesce(first_confirmed_date, first_icd_date) dx_date
-, coalesce(first_confirmed_year, first_icd_year) dx_year
-from first_icd
-left join first_confirmed using (d_person_id)
-"""
-#pd.read_sql(sql, connection)
-
-
-# %%
-tmp = connection.execute(text(f"""create or replace view _lca_dx as
-    {sql}
-    """))
+# the first LCa diagnosis date of each patient in the view _lca_dx (the
+# lca_dx stage), see cohort.lca_dx_sql
 #pd.read_sql('select count(*) from _lca_dx', connection)
 
 
 # %%
-tmp = pd.read_sql("""
+tmp = read_sql_cached("""
 select * from _lca_dx
 where dx_year>2020 or dx_year<2003
 order by dx_year
-""", connection)
+""", connection, cache_dir, tables=['_lca_dx'], stamps=session_stamps)
 
 
 # %%
-tmp = pd.read_sql("""
+tmp = read_sql_cached("""
 select greatest(2,4,null), least(2, 4, null)
-""", connection)
+""", connection, cache_dir, tables=[], stamps=session_stamps)
 
 
 # %%
-sql = """
-with range_visit as (
-    select d_person_id, min(visit_date) first_visit, max(visit_date) last_visit
-    from visits
-    group by d_person_id
-), range_dx as (
-    select d_person_id, min(event_date) first_dx, max(event_date) last_dx
-    from person_icd_codes
-    group by d_person_id
-), range_proc as (
-    select d_person_id, min(procedure_date) first_proc, max(procedure_date) last_proc
-    from procedure_occurrences
-    group by d_person_id
-), range_med as (
-    select d_person_id, min(date_of_medication) first_med, max(date_of_medication) last_med
-    from medications
-    group by d_person_id
-)
--- select * from range_visit
-select d_person_id
-, cohort
-, dx_date
-, least(coalesce(first_visit, 99999)
-    , coalesce(first_dx, 99999)
-    , coalesce(first_proc, 99999)
-    , coalesce(first_med, 99999)
-    ) first_visit_date
-, greatest(coalesce(last_visit, 0)
-    , coalesce(last_dx, 0)
-    , coalesce(last_proc, 0)
-    , coalesce(last_med, 0)
-    ) last_visit_date
-from v_s4_lca_cohort
-join _lca_dx using (d_person_id)
-left join range_visit using (d_person_id)
-left join range_dx using (d_person_id)
-left join range_proc using (d_person_id)
-left join range_med using (d_person_id)
-group by d_person_id, cohort, dx_date
-"""
+# the first and last event date of each person in visits, person_icd_codes,
+# procedure_occurrences and medications, kept in s4_person_event_span.
+# The four sources are scanned in parallel; after new events arrive,
+# span.update_source_span merges them in without a full rebuild (the
+# event_span stage).
+
+
+# %%
+# the dx date and the first and last visit date of each patient of the cohorts
+# in _lca_range (the lca_range stage), see pipeline.lca_range_sql
+#print(lca_range_sql)
 # print(data.shape)
 # some patients (n=201) has no visit data?
 # data.first_visit_date.isna().sum()
 
 
 # %%
-connection.execute("drop table if exists _lca_range")
-tmp = connection.execute(text(f"""
-create table _lca_range as 
-{sql}
-"""))
+# timing of the downstream joins with the former v_s4_lca_cohort view vs. s4_lca_cohort,
+# on demand (it runs the former view three times per query)
+#tmp = benchmark_lca_cohort(connection, min_days=lca_min_days)
 
 
 # %%
 #debug
-tmp = pd.read_sql("""
+tmp = read_sql_cached("""
     select count(distinct d_person_id) patients
     from v_s4_lca_cohort
     left join visits using (d_person_id)
     where visit_date is null
-    """, connection)
+    """, connection, cache_dir, tables=['s4_lca_cohort', 'visits'],
+    stamps=session_stamps)  # v_s4_lca_cohort is over s4_lca_cohort
 
 
 # %%
 #debug
-tmp = pd.read_sql("""
+tmp = read_sql_cached("""
     select dx_date is not null, count(distinct d_person_id)
     from _lca_dx
     group by dx_date is not null
-    """, connection)
+    """, connection, cache_dir, tables=['_lca_dx'], stamps=session_stamps)
 
 
 # %%
 # debug
-tmp = pd.read_sql("""
+tmp = read_sql_cached(f"""
     select d_person_id
     , min(event_date) first_icd_date
     from person_icd_codes
-    where (icd_code like 'C34%' or icd_code like '162%')
+    where {prefix_where_sql('icd_code')}
     group by d_person_id
-    """, connection)
+    """, connection, cache_dir, tables=['person_icd_codes'], stamps=session_stamps)
 # tmp.first_icd_date.isna().sum()
 
 
 # %%
-tmp = pd.read_sql(text("""
+tmp = read_sql_cached(text(f"""
     select d_person_id
     , min(event_date) first_icd_date
     from person_icd_codes
-    where (icd_code like 'C34%' or icd_code like '162%')
+    where {prefix_where_sql('icd_code')}
         and event_date is not null
     group by d_person_id
-    """), connection)
+    """), connection, cache_dir, tables=['person_icd_codes'], stamps=session_stamps)
 # tmp.first_icd_date.isna().sum() #353
 # len(tmp) #12863
 
 
 # %%
-data = pd.read_sql("""
+data = read_sql_cached("""
 select * from _lca_range
-""", connection)
+""", connection, cache_dir, tables=['_lca_range'], stamps=session_stamps)
 
 
 # %%
-data = pd.concat([
-        data.assign(followup_days=data.dx_date-data.first_visit_date+1, followup_type='pre_dx'),
-        data.assign(followup_days=data.last_visit_date-data.dx_date+1, followup_type='post_dx'),
-])
+#long format of pre_dx and post_dx, with the outliers fixed and log10_followup_days
+data = followup_long(data)
 
 
 # %%
@@ -333,30 +288,17 @@ followup_days = data.followup_days
 
 
 # %%
-tmp = pd.read_sql("""
+tmp = read_sql_cached("""
 select count(*) from _lca_dx where dx_date is null
-""", connection)
+""", connection, cache_dir, tables=['_lca_dx'], stamps=session_stamps)
 #343
 
 
-# %%
-#quickfix the outliers
-followup_days = data.followup_days.fillna(0)
-followup_days[followup_days<0] = 0
-data = data.assign(followup_days=followup_days)
-followup_days[followup_days<1] = 1
-data = data.assign(log10_followup_days=np.log10(followup_days))
-#data.shape
-
-
 # %%
 #summary
-followup_type_order = ['pre_dx', 'post_dx']
 #print ('Summary statistics for follow up days in Log10 scale:')
-#summ = data.groupby(['cohort', 'followup_type']).log10_followup_days.describe()
-summ = data.groupby(['cohort', 'followup_type']).followup_days.describe()
-multi_index = pd.MultiIndex.from_product([cohort_order, followup_type_order])
-summ.reindex(multi_index)[describe_order]
+#followup_summary(data, cohort_order, describe_order, value='log10_followup_days')
+followup_summary(data, cohort_order, describe_order)
 
 # %% [markdown]
 # Visualization:
@@ -418,19 +360,10 @@ pd.read_sql(text("""
 
 
 # %%
-connection.execute(text("""
-    drop table if exists _note_ggo_before_dx;
-    """))
-connection.execute(text("""
-    create table _cohort_ggo_before_dx as (
-        select distinct d_person_id
-        from notes_ggo 
-        join v_s4_lca_cohort using (d_person_id)
-        join _lca_dx using (d_person_id)
-        where ggo_level1 like 'GGO_term%'
-            and dx_date>=note_date
-    )
-    """))
+# the patients of the cohorts with a GGO report before their dx in
+# _cohort_ggo_before_dx (the cohort_ggo_before_dx stage), see
+# pipeline.cohort_ggo_before_dx_sql
+#print(cohort_ggo_before_dx_sql)
 
 # %% [markdown]
 # 
@@ -438,79 +371,18 @@ connection.execute(text("""
 %run -i -n code/func.py
 #from func import qc_base, run_to_csv
 # %%
-# create baseline_size_max biggest size on the first report with size, together with ggo_date
-
-base = """
-    with _size as (
-        select d_person_id, note_date ggo_date, ggo_level2 size_cat, cast(ggo_level3 as float) size
-        from _cohort_ggo_before_dx
-        join notes_ggo using (d_person_id)
-        where ggo_level1='GGO_size'
-        -- group by d_person_id, ggo_date
-    ), result as (
-        select *
-        from (select *, row_number() over(
-                partition by d_person_id
-                order by ggo_date, size desc) rn
-            from _size) tmp
-        where rn=1
-    )
-"""
-qc_base(base)
-tablename='baseline_size_cat'
-run_to_csv(tablename, base)
-
-
-## baseline GGO number
-def get_base_first_max(ggo_level1):
-    return """
-    with _cat as (
-        select d_person_id, note_date ggo_date, ggo_level2 cat
-        from _cohort_ggo_before_dx
-        join notes_ggo using (d_person_id)
-        where ggo_level1='{ggo_level1}'
-    ), result as (
-        select *
-        from (select *, row_number() over(
-                partition by d_person_id
-                order by ggo_date, cat desc) rn
-            from _cat) tmp
-        where rn=1
-    )
-"""
-#qc
-base = get_base_first_max(ggo_level1)
-qc_base(base)
-tablename='baseline_number_cat'
-run_to_csv(tablename, base)
-
-## baseline exclusive location
-# %%
-# create the assistant table
-base = """with _location as (
-        select distinct d_person_id, note_date ggo_date, concat(ggo_level2, ':', ggo_level3) cat
-        from _cohort_ggo_before_dx
-        join notes_ggo using (d_person_id)
-        where ggo_level1='GGO_location'
-            and ifnull(ggo_level3, 'other') != 'other'
-    ), _exclusive as (
-        select d_person_id, ggo_date
-        from _location
-        group by d_person_id, ggo_date
-        having (count(*)=1)     
-    ), result as (
-        select *
-        from (select *, row_number() over(
-                partition by d_person_id
-                order by ggo_date, cat) rn
-            from _location 
-            join _exclusive using (d_person_id, ggo_date)) tmp
-        where rn=1      
-    )"""
-qc_base(base)
-tablename = 'baseline_ex_location_uml'
-df = run_to_table(tablename, base)
-df.to_csv(f'{working_dir}/{tablename}.csv', index=False)
+# the baseline tables before dx from one scan of notes_ggo, see baseline.baseline_specs:
+# * baseline_size_cat: the biggest size on the first report with size, together with ggo_date
+# * baseline_number_cat: the first GGO number
+# * baseline_ex_location_uml: the first exclusive location
+# * last_status_cat: the status change to dx
+# * first_potential_cause_cat: the first potential reason before dx
+# (built by the baselines stage)
+from baseline import baseline_specs, baseline_qc
+qc = baseline_qc(connection, baseline_specs)
+print(qc)
+for spec in baseline_specs:
+    export_table(spec['name'], f"{working_dir}/{spec['name']}.csv")
 
 #from each patient gather the follow columns at index_date (ggo_date)
 #smoking_status: latest 
@@ -520,131 +392,19 @@ df.to_csv(f'{working_dir}/{tablename}.csv', index=False)
 #ctab = make_patient_info_from_db(connection)
 ## create_patient_info.sql
 tablename = 'baseline_ex_location_patient_info'
-pd.read_sql(f'select * from {tablename}', connection)\
-    .to_csv(f'{working_dir}/{tablename}.csv', index=False)
+export_table(tablename, f'{working_dir}/{tablename}.csv')
 
 #compile the patient data for clinical summary by GT R package
 #plot clinical table in R
 #atable(df, group_col=cat, taget_cols=c(age_group, gender, race))
 
-## last status to dx
-#make a status_change rank table later
-level2_case = """case ggo_level2
-            when 'resolved/disappeared' then '01.resolved'
-            when 'decreased/improved/reduced/shrink' then '02.decreased'
-            when 'stable/no change/persistent' then '03.stable'
-            when 'increased/progressed' then '04.increased'
-            end"""
-base = f"""
-    with _cat as (
-        select d_person_id, note_date ggo_date
-        , {level2_case} cat
-        from _cohort_ggo_before_dx
-        join notes_ggo using (d_person_id)
-        join _lca_dx using (d_person_id)
-        """  """where ggo_level1='GGO_status_change'
-            and ifnull(ggo_level2, '') != ''
-            and note_date<=dx_date
-    ), result as (
-        select *
-        from (select *, row_number() over(
-                partition by d_person_id
-                order by ggo_date, cat desc) rn
-            from _cat) tmp
-        where rn=1
-    )
-"""
-qc_base(base)
-tablename='last_status_cat'
-run_to_csv(tablename, base)
-
-## first potential reason before dx
-level2_case = """case ggo_level2
-    when 'infectious_inflammatory' then '02.infect/inflam'
-    when 'other' then '01.other'
-    when 'malignant neoplasm' then '04.malignant'
-    when 'premalignancy' then '03.premalig'
-    end"""
-level1_name = 'GGO_potential_cause
-base = f"""
-    with _cat as (
-        select d_person_id, note_date ggo_date
-        , {level2_case} cat
-        from _cohort_ggo_before_dx
-        join notes_ggo using (d_person_id)
-        join _lca_dx using (d_person_id)
-        """  """where ggo_level1='{level1_name}'
-            and ifnull(ggo_level2, '') != ''
-            and note_date<=dx_date
-    ), result as (
-        select *
-        from (select *, row_number() over(
-                partition by d_person_id
-                order by ggo_date, cat desc) rn
-            from _cat) tmp
-        where rn=1
-    )
-"""
 ##### run the draft_v2.2.R for summary and heatmap
 
-    with ggo_note as (
-        select distinct d_person_id, note_date, radiology_id is not null as is_radiology
-        from notes_ggo
-        where GGO_level1 like 'GGO_term%'
-        order by d_person_id, note_date, is_radiology
-    ), first_ggo as (
-        select d_person_id
-        , min(note_date) first_ggo_date
-        from ggo_note
-        group by d_person_id
-    ), first_ct_chest as (
-       select d_person_id
-        , cast(floor(min(radiology_date)/365.25) as signed) first_ct_chest_age
-        , min(year_radiology_date) first_ct_chest_year
-        from _ct_chest
-        group by d_person_id 
-    ), cohort as (
-        select d_person_id
-        , first_ggo_date
-        from first_ggo
-        left join first_ct_chest using(d_person_id)
-        where (first_ct_chest_age is null or first_ct_chest_age >= 18)
-            and (first_ct_chest_year is null or first_ct_chest_year between 2003 and 2020)
-    ), patient_ggo_rads as (
-        select d_person_id
-        , count(distinct note_date) ggo_rads
-        from ggo_note
-        where is_radiology
-        group by d_person_id
-    ), patient_ggo_other as (
-        select d_person_id
-        , count(distinct note_date) ggo_other
-        from ggo_note
-        where not is_radiology
-        group by d_person_id
-    ), patient_rads as (
-        select d_person_id
-        , count(distinct radiology_date) rads -- consider rads reported in the same day as one
-        from radiologies
-        group by d_person_id
-    )
-    -- select *
-    select d_person_id, cohort, first_ggo_date
-    , coalesce(rads, 0) total_radiology_reports
-    , coalesce(ggo_rads, 0) radiology_reports_with_ggo
-    , coalesce(ggo_other, 0) other_reports_with_ggo
-    -- , first_scan_date, last_scan_date -- nullable
-    from cohort
-    left join patient_rads using (d_person_id)
-    left join patient_ggo_rads using (d_person_id)
-    left join patient_ggo_other using (d_person_id)
-    -- left join patient_first_last_scan using (d_person_id)
-    join v_s4_lca_cohort using (d_person_id)
-    """
-tmp = connection.execute(text(f"""
-    create or replace view _patient_ggo as 
-    {sql}"""))
-#patient_ggo = pd.read_sql(text(sql), connection)
+# %%
+# the first GGO report of each adult patient of the cohorts in the view
+# _patient_ggo (the patient_ggo stage), see pipeline.patient_ggo_sql
+#print(patient_ggo_sql)
+#patient_ggo = pd.read_sql(text(patient_ggo_sql), connection)
 #patient_cohort = pd.read_sql("select * from v_s4_lca_cohort", connection)
 #data = sqldf("""select * from patient_ggo join patient_cohort using (d_person_id)""", locals())
 #patient_ggo
@@ -709,15 +469,19 @@ g = sns.catplot(data=data_melt, kind='box', #.assign(log10_of_reports=np.log10(d
 # * A histogram of the same distribution:  days are on log10 scale. Note that a patient can be counted only in one bin.
 
 # %%
-sql = """
-    select d_person_id, cohort
-    , min(radiology_date-first_ggo_date) as closest_scan_post_ggo
-    from _patient_ggo
-    join _ct_chest using (d_person_id)
-    where radiology_date>first_ggo_date
-    group by d_person_id, cohort
-    """
-data = pd.read_sql(sql, connection)
+# the first CT chest after the index GGO report, by a sorted merge (merge_asof)
+# patient_ggo is reused by the window joins of 2.f and 2.g
+from window import nearest_after, within_window
+patient_ggo = pd.read_sql("select d_person_id, cohort, first_ggo_date from _patient_ggo",
+                          connection)
+ct_chest = pd.read_sql("""
+    select distinct d_person_id, radiology_date
+    from _ct_chest
+    join _patient_ggo using (d_person_id)
+    """, connection)
+data = nearest_after(patient_ggo, ct_chest, 'first_ggo_date', 'radiology_date')
+data = data.assign(closest_scan_post_ggo=data.radiology_date-data.first_ggo_date)\
+    [['d_person_id', 'cohort', 'closest_scan_post_ggo']]
 #data
 
 
@@ -869,29 +633,13 @@ join _lca_range lr using (d_person_id)
 
 
 # %%
-data = pd.concat([
-        data.assign(followup_days=data.dx_date-data.first_visit_date+1, followup_type='pre_dx'),
-        data.assign(followup_days=data.last_visit_date-data.dx_date+1, followup_type='post_dx'),
-])
-
-
-# %%
-#quickfix the outliers
-followup_days = data.followup_days.fillna(0)
-followup_days[followup_days<0] = 0
-data = data.assign(followup_days=followup_days)
-
-followup_days[followup_days<1] = 1
-data = data.assign(log10_followup_days=np.log10(followup_days))
-#data.shape
+#long format of pre_dx and post_dx, with the outliers fixed and log10_followup_days
+data = followup_long(data)
 
 
 # %%
 #summary
-followup_type_order = ['pre_dx', 'post_dx']
-summ = data.groupby(['cohort', 'followup_type']).followup_days.describe()
-multi_index = pd.MultiIndex.from_product([cohort_order, followup_type_order])
-summ.reindex(multi_index)[describe_order]
+followup_summary(data, cohort_order, describe_order)
 
 
 # %%
@@ -922,13 +670,14 @@ tmp.to_sql('ref_ggo_ct_type', con=connection, if_exists='replace')
 
 
 # %%
-data = pd.read_sql("""
-    select distinct d_person_id, procedure_type
+# the procedures within 30 days before the index GGO report (1 to 29 days)
+procedures = pd.read_sql("""
+    select distinct d_person_id, procedure_type, procedure_date
     from _procedure_ct_type
     join _patient_ggo using (d_person_id)
-    where first_ggo_date > procedure_date
-        and first_ggo_date-procedure_date<30
     """, connection)
+data = within_window(patient_ggo, procedures, 'first_ggo_date', 'procedure_date', -29, -1)\
+    [['d_person_id', 'procedure_type']].drop_duplicates()
 #data
 
 
@@ -952,35 +701,34 @@ tmp.to_sql('ref_ggo_icd_cm', con=connection, if_exists='replace')
 
 
 # %%
-res = pd.read_sql(text("""
-    with m as (
-        select count(distinct d_person_id) patients
-        from _patient_ggo p
-        join person_icd_codes pi using (d_person_id)
-        join ref_ggo_icd_cm r on pi.icd_code like concat(r.diagnosis_code, '%')
-        where abs(event_date-first_ggo_date)<30
-    ), total as (
-        select count(distinct d_person_id) patients
-        from _patient_ggo p
-    )
-    select m.patients matched_patients
-    , m.patients/total.patients * 100.0 percentage_matched
-    from m join total on 1
-    """),  connection, index_col='matched_patients')
+# the ICD codes filtered by their prefixes (like 'J18%'), then those within
+# 30 days of the index GGO report by a window join, then matched to each
+# reference code in memory, overall and per code in one pass
+ref_icd = tmp
+if snapshot_path is not None:
+    icd = read_snapshot('person_icd_codes', snapshot_dir, snapshot_path.name,
+                        columns=['d_person_id', 'icd_code', 'event_date'],
+                        persons=patient_ggo.d_person_id)
+    icd = icd[icd.icd_code.fillna('').str.startswith(tuple(ref_icd.diagnosis_code.astype(str)))].drop_duplicates()
+else:
+    icd = pd.read_sql(text(f"""
+        select distinct d_person_id, icd_code, event_date
+        from person_icd_codes
+        join _patient_ggo using (d_person_id)
+        where {prefix_where_sql('icd_code', ref_icd.diagnosis_code)}
+        """), connection)
+data = within_window(patient_ggo, icd, 'first_ggo_date', 'event_date', -29, 29)
+total = patient_ggo.d_person_id.nunique()
+matched_patients, icd_counts = prefix_patient_counts(data, ref_icd)
+res = pd.DataFrame(dict(matched_patients=[matched_patients],
+                        percentage_matched=[matched_patients / total * 100.0])
+                   ).set_index('matched_patients')
 res
 
 
 # %%
-# pd.read_sql("""select * from ref_ggo_icd_cm""", connection)
-pd.read_sql(text("""
-    select diagnosis_code, dx_description
-    , count(distinct d_person_id) patients
-    from _patient_ggo p
-    join person_icd_codes pi using (d_person_id)
-    join ref_ggo_icd_cm r on pi.icd_code like concat(r.diagnosis_code, '%')
-    where abs(event_date-first_ggo_date)<30
-    group by diagnosis_code, dx_description
-    """), connection)
+icd_counts
+
 
 # %% [markdown]
 # Finding: 
@@ -1001,31 +749,24 @@ pd.read_sql(text("""
 # 
 
 # %%
-data = pd.read_sql("""
-    select GGO_level2 GGO_potential_cause
-    , count(distinct d_person_id) patients
-    from notes_ggo
-    where GGO_level1='GGO_potential_cause'
-    group by GGO_level2
-    """, connection)
-data
+# the patients of each category for all the GGO levels in one scan of notes_ggo,
+# reused by the counts and Venn diagrams of section 2.h.
+# notes_ggo is loaded once with compact types (categorical levels, int32 ids
+# and dates, float32 ggo_size), from the snapshot, or from the database and
+# reloaded from parquet until it changes.
+from util import ggo_venn_levels, level_person_sets, level_patient_counts
+from notes import load_notes_ggo
+notes = load_notes_ggo(connection, working_dir/'notes_ggo.parquet', snapshot_path=snapshot_path,
+                       stamps=session_stamps)
+ggo_sets = level_person_sets(notes[notes.ggo_level1.isin(ggo_venn_levels) & notes.ggo_level2.notna()])
 
 
 # %%
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_potential_cause'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
+level_patient_counts(ggo_sets, 'GGO_potential_cause').to_frame()
 
 
 # %%
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g = venn.venn(data_)
+g = venn.venn(ggo_sets['GGO_potential_cause'])
 
 # %% [markdown]
 # Finding: 
@@ -1047,23 +788,15 @@ g = venn.venn(data_)
 #     * Blue line is for 6mm and red line for 20 mm 
 #     * The color scale is for number of patients in that bin (square) 
 
-# %%
-tmp = pd.read_sql("""
-    select GGO_level2 GGO_size_category
-    , count(distinct d_person_id) patients
-    from notes_ggo
-    where GGO_level1='GGO_size' and GGO_level2 is not null -- quickfix
-    group by GGO_level2
-    """, connection)
-
-
 # %%
 cat_order = ['<6mm(0.6cm)', '6-20mm(0.6-2cm)', '>20mm(2cm)']
-tmp.set_index('GGO_size_category').loc[cat_order, :]
+level_patient_counts(ggo_sets, 'GGO_size').to_frame().loc[cat_order, :]
 
 
 # %%
-data = pd.read_sql("""
+# the baseline (first date) and the latest size in one sort, the largest size of the date
+from pick import pick_sql
+data = pd.read_sql(f"""
 with _res as (
     select distinct d_person_id person_id
     , GGO_level2 ggo_size_category
@@ -1076,35 +809,17 @@ with _res as (
     select *
     from _res
     where ggo_size_in_mm < 1000 -- quickfix the outliers
-), earliest as (
-    select person_id
-    , ggo_size_in_mm
-    , ggo_size_category
-    , ggo_date
-    from (select *, row_number() over (
-            partition by person_id
-            order by ggo_date, ggo_size_in_mm desc) rn
-        from res) tmp
-    where rn=1
-), latest as (
-    select person_id
-    , ggo_size_in_mm
-    , ggo_size_category
-    , ggo_date
-    from (select *, row_number() over (
-            partition by person_id
-            order by ggo_date desc, ggo_size_in_mm desc) rn
-        from res) tmp
-    where rn=1
+), picked as (
+    {pick_sql('res', ['ggo_size_in_mm', 'ggo_size_category'],
+              tiebreak=['ggo_size_in_mm desc'], by='person_id')}
 )
 select person_id
-, earliest.ggo_size_in_mm baseline_ggo_size_in_mm
-, earliest.ggo_size_category baseline_ggo_size_category
-, latest.ggo_size_in_mm latest_ggo_size_in_mm
-, latest.ggo_size_category latest_ggo_size_category
-from earliest
-join latest using (person_id)
-where earliest.ggo_date != latest.ggo_date
+, first_ggo_size_in_mm baseline_ggo_size_in_mm
+, first_ggo_size_category baseline_ggo_size_category
+, last_ggo_size_in_mm latest_ggo_size_in_mm
+, last_ggo_size_category latest_ggo_size_category
+from picked
+where first_ggo_date != last_ggo_date
 ;
 """, connection)
 #data
@@ -1158,17 +873,7 @@ pd.read_sql("""
 
 
 # %%
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_location'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g = venn.venn(data_)
+g = venn.venn(ggo_sets['GGO_location'])
 
 # %% [markdown]
 # Findings: 
@@ -1183,17 +888,7 @@ g = venn.venn(data_)
 # * Most patients are reported to have multiple GGOs. 
 
 # %%
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_number'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g = venn.venn(data_)
+g = venn.venn(ggo_sets['GGO_number'])
 
 # %% [markdown]
 # ### 2.h - GGO shape margin
@@ -1205,17 +900,7 @@ g = venn.venn(data_)
 # * Lobulated shape is rarely reported. 
 
 # %%
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_shape_margin'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g= venn.venn(data_)
+g= venn.venn(ggo_sets['GGO_shape_margin'])
 
 # %% [markdown]
 # ### 2.h - GGO term
@@ -1228,17 +913,7 @@ g= venn.venn(data_)
 
 # %%
 # ggo_term
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_term'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g=venn.venn(data_)
+g=venn.venn(ggo_sets['GGO_term'])
 
 # %% [markdown]
 # ### 2.h - GGO solidity change
@@ -1254,17 +929,7 @@ g=venn.venn(data_)
 
 # %%
 # ggo_solidity
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_solidity'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g=venn.venn(data_)
+g=venn.venn(ggo_sets['GGO_solidity'])
 
 # %% [markdown]
 # ### 2.h - GGO status change
@@ -1273,17 +938,7 @@ g=venn.venn(data_)
 
 # %%
 # ggo_status_change
-data = pd.read_sql("""
-    select d_person_id, GGO_level2
-    , count(*)
-    from notes_ggo
-    where GGO_level1='GGO_status_change'
-    group by d_person_id, GGO_level2
-    """, connection)
-#data
-grouped = data.groupby('GGO_level2')
-data_ = {g: set(x['d_person_id']) for g, x in grouped}
-g=venn.venn(data_)
+g=venn.venn(ggo_sets['GGO_status_change'])
 
 # %% [markdown]
 # * Visualize the temporality (sequence of status changes) as Sankey diagram. Note that 
@@ -1342,6 +997,45 @@ g.write_html('status_change_first_10.html')
 #g.write_image('status_change_first_10.png')
 
 
+# %%
+# all status change reports of the full cohort, streamed by chunks
+# only the flow counts are kept in memory, the rows are not.
+from sankey import sankey_from_chunks
+status_change_sql = """
+with pick as (
+    select d_person_id, note_date
+    , max(GGO_level2_order) GGO_level2_order
+    from notes_ggo
+    join _status_change_order using (GGO_level2)
+    where GGO_level1='GGO_status_change' and GGO_level2 is not null and note_date is not null
+    group by d_person_id, note_date
+), raw as (
+    select d_person_id, note_date, GGO_level2
+    from pick
+    join _status_change_order using (GGO_level2_order)
+)
+select d_person_id person_id
+, substring(GGO_level2, 1, 3) cat
+, row_number() over (partition by d_person_id order by note_date) rnk
+from raw
+order by person_id, rnk
+"""
+chunks = pd.read_sql(status_change_sql,
+    connection.execution_options(stream_results=True), chunksize=100000)
+# merge the rare nodes (status and rank) into 'other' to keep the html small
+g = sankey_from_chunks(chunks, min_value=10)
+g.write_html('status_change_all.html')
+
+
+# %%
+# the repeated status of a patient (e.g. sta -> sta -> sta) collapsed into one,
+# so the real status changes are shown without truncating the reports.
+chunks = pd.read_sql(status_change_sql,
+    connection.execution_options(stream_results=True), chunksize=100000)
+g = sankey_from_chunks(chunks, collapse_runs=True)
+g.write_html('status_change_runs.html')
+
+
 # %%
 from IPython.display import HTML
 #HTML(filename='status_change_first_10.html')
@@ -1385,50 +1079,11 @@ order by d_person_id
 
 
 # %%
-query = """
-select d_person_id, note_date latest_date, date_count, ggo_level1, ggo_level2
-from notes_ggo
-join (
-    select d_person_id, count(distinct note_date) as date_count, max(note_date) as note_date
-    from notes_ggo
-    group by d_person_id
-) _date_sum using (d_person_id, note_date)
-order by d_person_id
-;
-"""
-# pd.read_sql(query, connection)
-tmp = connection.execute(f"""create or replace view _person_summary as {query}""")
-
-
-# %%
-query = """
-select *
-from (
-    SELECT d_person_id
-    from _person_summary
-    where date_count >1
-    and d_person_id not in (
-        SELECT d_person_id
-        from _person_summary
-        where date_count >1 -- and not with resolved in the last day report
-        and ggo_level1 = 'GGO_status_change' and ggo_level2 = 'resolved/disappeared'
-    )
-) as muti_not_resolved
-union
-select *
-from (
-    SELECT d_person_id
-	from _person_summary
-    where date_count=1 -- and with any stable/worsen reported
-        and (
-            (ggo_level1 = 'GGO_status_change' and ggo_level2 in ('stable/no change/persistent', 'increased/progressed'))
-            or ( ggo_level1 = 'GGO_solidity' and ggo_level2 in ('stable','increased'))
-        )
-) as single_changed
-;
-"""
-# pd.read_sql(query, connection)
-tmp = connection.execute(f"""create or replace view v_s4_persistent_cohort as {query}""")
+# the persistent cohort and the report level summary (below) are materialized
+# as the tables s4_persistent_cohort and s4_notes_ggo_summary, see util.py.
+# The first run builds them, later runs only recompute the patients with
+# new or changed reports in notes_ggo (the notes_ggo_summary stage, with the
+# views v_s4_persistent_cohort and v_s4_notes_ggo_summary).
 
 # %% [markdown]
 # ## v_s4_notes_ggo_summary: a report level summary of GGO.
@@ -1445,64 +1100,9 @@ tmp = connection.execute(f"""create or replace view v_s4_persistent_cohort as {q
 # * is_persistent: 'YES' if the patient has persistent GGO 
 
 # %%
-query = """select *
-from (select distinct d_person_id, note_date from notes_ggo
-) as note_info
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as term_types
-    from notes_ggo
-    where ggo_level1='GGO_term'
-    group by d_person_id, note_date
-) as term using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , max(cast(ggo_level3 as decimal)) as max_size
-    from notes_ggo
-    where ggo_level1='GGO_size'
-    group by d_person_id, note_date
-) as size using (d_person_id, note_date)
-left join  (select d_person_id, note_date
-    , group_concat(distinct concat(COALESCE(ggo_level2, '_'), '::', COALESCE(ggo_level3, '_')) 
-        order by concat(COALESCE(ggo_level2, '_'), '::', COALESCE(ggo_level3, '_')) separator ', ') as locations
-    from notes_ggo
-    where ggo_level1='GGO_location'
-    group by d_person_id, note_date
-) as loca using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as potential_causes
-    from notes_ggo
-    where ggo_level1='GGO_potential_cause'
-    group by d_person_id, note_date
-) as caus using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as shape_margins
-    from notes_ggo
-    where ggo_level1='GGO_shape_margin'
-    group by d_person_id, note_date
-) as shap using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as solidity_changes
-    from notes_ggo
-    where ggo_level1='GGO_solidity'
-    group by d_person_id, note_date
-) as soli using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as numbers
-    from notes_ggo
-    where ggo_level1='GGO_number'
-    group by d_person_id, note_date
-) as num using (d_person_id, note_date)
-left join (select d_person_id, note_date
-    , group_concat(distinct ggo_level2 order by ggo_level2 separator ', ') as status_changes
-    from notes_ggo
-    where ggo_level1='GGO_status_change'
-    group by d_person_id, note_date
-) as status_change using (d_person_id, note_date)
-left join (select d_person_id, 'Yes' as is_persistent
-    from v_s4_persistent_cohort) persistent using (d_person_id)
-order by d_person_id, note_date
-"""
-#pd.read_sql(query, connection)
-g = connection.execute(text(f"""create or replace view v_s4_notes_ggo_summary as {query}"""))
+# s4_notes_ggo_summary is built (or refreshed) in one grouped scan of
+# notes_ggo, v_s4_notes_ggo_summary is kept as a view over the table
+#pd.read_sql(util.notes_ggo_summary_sql(), connection)
 
 
 # %%
@@ -1510,6 +1110,28 @@ g = connection.execute(text(f"""create or replace view v_s4_notes_ggo_summary as
 pd.read_sql(f"""select * from v_s4_notes_ggo_summary""", connection)
 
 
+# %%
+# the plans of the stage queries compared with their first run, to catch a
+# plan flip (full scan, join without index, estimate blowup) after a refresh
+from plans import check_plans
+from baseline import baseline_table_sql
+from util import notes_ggo_summary_sql
+stage_queries = {
+    'lca_range': lca_range_sql,
+    'cohort_ggo_before_dx': cohort_ggo_before_dx_sql,
+    'patient_ggo': patient_ggo_sql,
+    'notes_ggo_summary': notes_ggo_summary_sql(persistent='s4_persistent_cohort'),
+}
+for spec in baseline_specs:
+    stage_queries[spec['name']] = (baseline_table_sql(spec, 'level1'), dict(level1=spec['level1']))
+check_plans(connection, stage_queries, f'{working_dir}/plans', seconds=stage_report.seconds.to_dict())
+
+
+# %%
+# the statements of this run ranked by their total time
+query_report(query_records, top=30, path=f'{working_dir}/query_report.json')
+
+
 # %%
 connection.close()
 """
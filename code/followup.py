@@ -0,0 +1,49 @@
+import numpy as np, pandas as pd
+
+# follow-up before and after the dx date, in long format (one row per person
+# and followup_type), built in one allocation per column instead of
+# concatenating copies of the cohort frame.
+followup_type_order = ['pre_dx', 'post_dx']
+
+def followup_long(df, columns=('d_person_id', 'cohort'), dx='dx_date',
+                  first='first_visit_date', last='last_visit_date'):
+    """return the follow-up days of each person in df before and after dx:
+    pre_dx = dx - first + 1 and post_dx = last - dx + 1.
+
+    The missing or negative days are set to 0, and log10_followup_days is
+    log10 of the days clipped at 1, as the quickfix of the outliers.
+
+    - columns: the columns of df repeated for both followup_type.
+
+    return a df with columns, followup_type (categorical of
+    followup_type_order), followup_days (int32) and log10_followup_days (float32).
+    """
+    n = len(df)
+    days = np.empty(2 * n, dtype='float32')
+    np.subtract(df[dx].to_numpy(dtype='float32'), df[first].to_numpy(dtype='float32'), out=days[:n])
+    np.subtract(df[last].to_numpy(dtype='float32'), df[dx].to_numpy(dtype='float32'), out=days[n:])
+    days += 1
+    # nan compares false, so it is set along the negative days
+    days[~(days >= 0)] = 0
+    res = {}
+    for col in columns:
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            # the codes are repeated instead of the values
+            values = values.astype('category')
+            res[col] = pd.Categorical.from_codes(np.tile(values.cat.codes.to_numpy(), 2),
+                                                 dtype=values.dtype)
+        else:
+            res[col] = np.tile(values.to_numpy(), 2)
+    res['followup_type'] = pd.Categorical.from_codes(np.repeat(np.int8([0, 1]), n),
+                                                     followup_type_order)
+    res['followup_days'] = days.astype('int32')
+    res['log10_followup_days'] = np.log10(np.maximum(days, 1, out=days), out=days)
+    return pd.DataFrame(res)
+
+def followup_summary(data, cohort_order, describe_order, value='followup_days'):
+    """return the describe table of the follow-up of each cohort and followup_type,
+    in the order of cohort_order and followup_type_order."""
+    summ = data.groupby(['cohort', 'followup_type'], observed=True)[value].describe()
+    multi_index = pd.MultiIndex.from_product([cohort_order, followup_type_order])
+    return summ.reindex(multi_index)[describe_order]
@@ -1,9 +1,5 @@
-
-case_days = """case when days_ggo_before_dx<180 then '<6M'
-            when days_ggo_before_dx<365 then '6M-1y'
-            when days_ggo_before_dx<365*3 then '1-3y'
-            else '>=3y'
-            end """
+from baseline import case_days
+from util import arrow_schema
 
 def qc_base(base):
     res = pd.read_sql(text(f"""
@@ -16,10 +12,10 @@ def qc_base(base):
     print (res)
 
 #using case_days, working_dir
-def run_to_table(table_name, base):
+def run_to_table(table_name, base, read_back=True):
     # create the summary table
-    connection.execute(f"""drop table if exists {tablename}""")
-    connection.execute(text(f"""create table {tablename} as
+    connection.execute(f"""drop table if exists {table_name}""")
+    connection.execute(text(f"""create table {table_name} as
         {base}
         , raw as (
             select *, dx_date-ggo_date days_ggo_before_dx
@@ -31,11 +27,40 @@ def run_to_table(table_name, base):
         , {case_days} as date_cat
         from raw
         """)) #, connection)
-    df = pd.read_sql(f'select * from {tablename}', connection)
-    return df
-def run_to_csv(table_name, base):
-    df = run_to_table(table_name, base)
-    df.to_csv(f'{working_dir}/{tablename}.csv', index=False)
+    if read_back:
+        df = pd.read_sql(f'select * from {table_name}', connection)
+        return df
+
+def export_table(table_name, path, chunksize=100000):
+    """write a table into path by chunks, read with a server-side cursor,
+    so the memory does not grow with the table.
+
+    The format follows the suffix of path: .parquet (with the schema of the
+    table), or csv with an optional compression suffix that can be appended
+    to, e.g. .csv.gz; not .zip or .tar, whose chunks would be separate members.
+    """
+    path = str(path)
+    if path.endswith(('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        raise ValueError(f'{path}: cannot append to a zip or tar archive, use e.g. .csv.gz')
+    chunks = pd.read_sql(f'select * from {table_name}',
+                         connection.execution_options(stream_results=True),
+                         chunksize=chunksize)
+    writer = None
+    if path.endswith('.parquet'):
+        import pyarrow as pa, pyarrow.parquet as pq
+        schema = arrow_schema(connection, table_name)
+        writer = pq.ParquetWriter(path, schema)
+    for i, chunk in enumerate(chunks):
+        if writer is not None:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        else:
+            chunk.to_csv(path, mode='a' if i else 'w', header=not i, index=False)
+    if writer is not None:
+        writer.close()
+
+def run_to_csv(table_name, base, suffix='.csv'):
+    run_to_table(table_name, base, read_back=False)
+    export_table(table_name, f'{working_dir}/{table_name}{suffix}')
 
 def make_patient_info_from_db(connection, cohort='cohort'):
     sql =
\ No newline at end of file
@@ -0,0 +1,55 @@
+import numpy as np, pandas as pd
+
+# ICD-10 C34 and ICD-9 162 for lung cancer
+lca_icd_prefixes = ['C34', '162']
+
+def prefix_range(prefix):
+    """return the range [lo, hi) of the codes starting with prefix in binary
+    order, e.g. ('C34', 'C35'), for the sorted codes in memory; not for sql,
+    where the collation orders the characters differently."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def prefix_where_sql(column, prefixes=lca_icd_prefixes):
+    """return the sql condition of column starting with any of the prefixes,
+    as like 'prefix%' (without a leading wildcard, so an index can be used)."""
+    likes = [f"{column} like '{prefix}%'" for prefix in sorted(set(prefixes))]
+    return '(' + '\n    or '.join(likes) + ')'
+
+def match_prefixes(codes, prefixes):
+    """match each code to every prefix it starts with.
+
+    The distinct codes are sorted once, then the codes of each prefix are a
+    contiguous range found by binary search.
+
+    return (code_index, prefix_index): the positions in codes and prefixes
+    of each match.
+    """
+    codes = pd.Series(codes).fillna('').astype(str).to_numpy()
+    prefixes = pd.Series(prefixes).astype(str).to_numpy()
+    uniq, inverse = np.unique(codes, return_inverse=True)
+    ranges = [prefix_range(p) for p in prefixes]
+    lo = np.searchsorted(uniq, [lo for lo, hi in ranges], side='left')
+    hi = np.searchsorted(uniq, [hi for lo, hi in ranges], side='left')
+    # expand the ranges into (distinct code, prefix) pairs
+    n = hi - lo
+    prefix_index = np.repeat(np.arange(len(prefixes)), n)
+    uniq_index = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+    pairs = pd.DataFrame(dict(uniq_index=uniq_index, prefix_index=prefix_index))
+    rows = pd.DataFrame(dict(uniq_index=inverse.reshape(-1), code_index=np.arange(len(codes))))
+    matched = rows.merge(pairs, on='uniq_index')
+    return matched.code_index.to_numpy(), matched.prefix_index.to_numpy()
+
+def prefix_patient_counts(df, ref, code_col='icd_code', prefix_col='diagnosis_code',
+                          by=('diagnosis_code', 'dx_description')):
+    """count the patients in df with (d_person_id, code_col, ..) matching the
+    prefixes in ref, overall and for each prefix, in one pass.
+
+    return (matched_patients, counts): the number of patients matching any
+    prefix, and a df with the number of patients for each `by` of ref.
+    """
+    code_index, prefix_index = match_prefixes(df[code_col], ref[prefix_col])
+    matched = pd.DataFrame(dict(d_person_id=df.d_person_id.to_numpy()[code_index]))
+    for col in by:
+        matched[col] = ref[col].to_numpy()[prefix_index]
+    counts = matched.groupby(list(by), dropna=False).d_person_id.nunique().rename('patients').reset_index()
+    return matched.d_person_id.nunique(), counts
@@ -0,0 +1,92 @@
+from pathlib import Path
+import numpy as np, pandas as pd
+from util import ggo_venn_levels
+from snapshot import source_version, read_snapshot
+
+# notes_ggo in pandas with compact types: ggo_level1/2/3 as categoricals (the
+# codes of the known values below are fixed, the other values follow sorted),
+# int32 ids and day-number dates (int64 if out of the int32 range), and the
+# GGO size parsed once into float32 ggo_size, e.g. for the Venn sets or the
+# baseline analyses in pandas.
+ggo_level1_vocab = list(ggo_venn_levels)
+ggo_level2_vocab = [
+    'pure', 'mixed',
+    '<6mm(0.6cm)', '6-20mm(0.6-2cm)', '>20mm(2cm)',
+    'single', 'multiple',
+    'resolved/disappeared', 'decreased/improved/reduced/shrink',
+    'stable/no change/persistent', 'increased/progressed',
+    'infectious_inflammatory', 'other', 'malignant neoplasm', 'premalignancy',
+    'stable', 'increased', 'decreased',
+]
+notes_columns = ['d_person_id', 'note_date', 'radiology_id', 'ggo_level1', 'ggo_level2', 'ggo_level3']
+
+def _compact_int(values):
+    # int32, or int64 if a value is out of its range (a cast would wrap it)
+    values = pd.to_numeric(values)
+    info = np.iinfo('int32')
+    bits = 32 if values.dropna().between(info.min, info.max).all() else 64
+    if values.isna().any():
+        return values.astype(f'Int{bits}')
+    return values.astype(f'int{bits}')
+
+def compact_notes_ggo(df):
+    """return df (a notes_ggo chunk or table) with the compact types; the
+    ggo_level categories are those of the chunk, see concat_notes_ggo."""
+    res = pd.DataFrame(index=pd.RangeIndex(len(df)))
+    for col in ['d_person_id', 'note_date', 'radiology_id']:
+        if col in df:
+            res[col] = _compact_int(df[col]).array
+    for col in ['ggo_level1', 'ggo_level2', 'ggo_level3']:
+        if col in df:
+            res[col] = pd.Categorical(df[col].to_numpy())
+    if 'ggo_level3' in df and 'ggo_level1' in df:
+        size = np.where(df.ggo_level1.to_numpy() == 'GGO_size', df.ggo_level3.to_numpy(), None)
+        res['ggo_size'] = pd.to_numeric(pd.Series(size), errors='coerce').astype('float32').to_numpy()
+    return res
+
+def _vocab_categories(values, vocab):
+    # the known values first, in vocab order, then the others sorted
+    vocab = vocab or []
+    return vocab + sorted(set(values.categories) - set(vocab))
+
+def concat_notes_ggo(chunks):
+    """concat the compact chunks into one df, with the ggo_level categories in
+    the vocabulary order."""
+    chunks = [c for c in chunks]
+    if not chunks:
+        return compact_notes_ggo(pd.DataFrame(columns=notes_columns))
+    res = pd.concat([c.drop(columns=['ggo_level1', 'ggo_level2', 'ggo_level3'], errors='ignore')
+                     for c in chunks], ignore_index=True)
+    vocabs = dict(ggo_level1=ggo_level1_vocab, ggo_level2=ggo_level2_vocab, ggo_level3=None)
+    for col, vocab in vocabs.items():
+        if col in chunks[0]:
+            values = pd.api.types.union_categoricals([c[col] for c in chunks])
+            res[col] = values.set_categories(_vocab_categories(values, vocab))
+    # the same column order as the chunks
+    return res[list(chunks[0].columns)]
+
+def load_notes_ggo(connection, path=None, chunksize=500000, columns=notes_columns,
+                   snapshot_path=None, stamps=None):
+    """return notes_ggo with the compact types, read from the local snapshot
+    at snapshot_path (see snapshot.take_snapshot) if given, otherwise by chunks
+    from the database, or from the parquet file at path if it is there for
+    the current version of notes_ggo (the file name takes the version, from
+    the stamps if given, see snapshot.source_stamps).
+    """
+    if snapshot_path is not None:
+        snapshot_path = Path(snapshot_path)
+        df = read_snapshot('notes_ggo', snapshot_path.parent, snapshot_path.name, columns=columns)
+        return concat_notes_ggo([compact_notes_ggo(df)])
+    version = source_version(connection, ['notes_ggo'], stamps)
+    if path is not None:
+        path = Path(path)
+        path = path.with_name(f'{path.stem}_{version}{path.suffix}')
+        if version is not None and path.exists():
+            return pd.read_parquet(path)
+    chunks = pd.read_sql(f"select {', '.join(columns)} from notes_ggo",
+                         connection.execution_options(stream_results=True), chunksize=chunksize)
+    df = concat_notes_ggo(compact_notes_ggo(chunk) for chunk in chunks)
+    if path is not None and version is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(path, index=False)
+    return df
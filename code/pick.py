@@ -0,0 +1,67 @@
+import numpy as np, pandas as pd
+
+# the first, last and nth record of each patient, e.g. the baseline and
+# endpoint GGO size, from one sort of the records instead of one window scan
+# each. The records are ordered by date then by the tiebreak, so that the
+# first record is the best (e.g. largest size) of the first date, and the last
+# record the best of the last date:
+# * tiebreak: expressions with an optional asc/desc, e.g. ['size desc'], or a
+#   sql expression of the severity order, e.g. "field(cat, 'resolved', ..) desc".
+#   pick_rows only takes column names, ordered categoricals follow their order.
+# * nth: the nth record (from 1) in this order, if any.
+
+def pick_sql(source, columns, date='ggo_date', tiebreak=(), by='d_person_id',
+             picks=('first', 'last'), nth=None):
+    """return the sql of one row per `by` with the columns of its first, last
+    and nth record in source (a table or a subquery with alias), as
+    {pick}_{column} and {pick}_{date}."""
+    order = ', '.join([date, *tiebreak])
+    picks = [*picks, 'nth'] if nth else list(picks)
+    is_pick = dict(first='rn = 1', nth=f'rn = {nth}',
+                   last=f'{date} = last_date and (prev_date is null or prev_date != {date})')
+    values = ''.join(f'\n, max(case when {is_pick[p]} then {c} end) {p}_{c}'
+                     for p in picks for c in [date, *columns])
+    return f"""\
+select {by}{values}
+from (
+    select *
+    , row_number() over w rn
+    , lag({date}) over w prev_date
+    , max({date}) over (partition by {by}) last_date
+    from {source}
+    window w as (partition by {by} order by {order})
+) as ranked
+group by {by}"""
+
+def pick_rows(df, columns, date='ggo_date', tiebreak=(), by='d_person_id',
+              picks=('first', 'last'), nth=None):
+    """the pandas version of pick_sql, with one sort of df.
+
+    return a df indexed by `by`, with the columns {pick}_{column} and {pick}_{date}.
+    """
+    keys = [by, date]
+    ascending = [True, True]
+    for expr in tiebreak:
+        col, _, direction = expr.partition(' ')
+        keys.append(col)
+        ascending.append(direction.strip().lower() != 'desc')
+    df = df.sort_values(keys, ascending=ascending, kind='mergesort', na_position='first')
+    person = df[by].to_numpy()
+    dates = df[date].to_numpy()
+    n = len(df)
+    new_person = np.ones(n, dtype=bool)
+    new_person[1:] = person[1:] != person[:-1]
+    new_date = new_person.copy()
+    new_date[1:] |= ~((dates[1:] == dates[:-1]) | (pd.isna(dates[1:]) & pd.isna(dates[:-1])))
+    # the last date of each person, repeated over its records
+    starts = np.flatnonzero(new_person)
+    sizes = np.diff(np.append(starts, n))
+    last_date = np.repeat(dates[starts + sizes - 1], sizes)
+    masks = dict(first=new_person, last=new_date & (dates == last_date))
+    if nth:
+        rn = np.arange(n) - np.repeat(starts, sizes) + 1
+        masks['nth'] = rn == nth
+    picks = [*picks, 'nth'] if nth else list(picks)
+    res = [df.loc[masks[p], [by, date, *columns]].set_index(by).add_prefix(f'{p}_')
+           for p in picks]
+    return pd.concat(res, axis=1).reindex(person[starts])
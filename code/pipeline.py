@@ -0,0 +1,141 @@
+from sqlalchemy import text
+from stages import sql_stage
+from util import create_table_sql
+from cohort import build_lca_cohort, lca_dx_sql
+from span import build_event_span, span_sources
+from baseline import baseline_specs, build_baselines
+from refresh import refresh_notes_ggo_summary
+from radiology import build_radiology_class
+
+# the analysis tables of the draft as stages (see stages.run_stages), built
+# once at the start of the draft, then read by its sections:
+# * s4_lca_cohort / v_s4_lca_cohort: the LCa cohorts (1.a)
+# * s4_radiology_class / _ct_chest: the radiology reports tagged (1.c)
+# * _lca_dx: the LCa dx date (1.d)
+# * s4_person_event_span, _lca_range: the observation time (1.d)
+# * _cohort_ggo_before_dx and the baseline tables (baseline.baseline_specs)
+# * _patient_ggo: the index GGO report of each patient (2.a)
+# * s4_persistent_cohort, s4_notes_ggo_summary and their views (3)
+
+# the dx date and the first and last event date of each patient of the cohorts
+lca_range_sql = """
+select d_person_id
+, cohort
+, dx_date
+, coalesce(first_event_date, 99999) first_visit_date
+, coalesce(last_event_date, 0) last_visit_date
+from v_s4_lca_cohort
+join _lca_dx using (d_person_id)
+left join s4_person_event_span using (d_person_id)
+"""
+
+# the patients of the cohorts with a GGO report before their dx
+cohort_ggo_before_dx_sql = """
+        select distinct d_person_id
+        from notes_ggo
+        join v_s4_lca_cohort using (d_person_id)
+        join _lca_dx using (d_person_id)
+        where ggo_level1 like 'GGO_term%'
+            and dx_date>=note_date"""
+
+# the first GGO report of each adult patient of the cohorts, with the number
+# of radiology reports (with GGO) and other reports with GGO
+patient_ggo_sql = """
+    with ggo_note as (
+        select distinct d_person_id, note_date, radiology_id is not null as is_radiology
+        from notes_ggo
+        where GGO_level1 like 'GGO_term%'
+        order by d_person_id, note_date, is_radiology
+    ), first_ggo as (
+        select d_person_id
+        , min(note_date) first_ggo_date
+        from ggo_note
+        group by d_person_id
+    ), first_ct_chest as (
+       select d_person_id
+        , cast(floor(min(radiology_date)/365.25) as signed) first_ct_chest_age
+        , min(year_radiology_date) first_ct_chest_year
+        from _ct_chest
+        group by d_person_id
+    ), cohort as (
+        select d_person_id
+        , first_ggo_date
+        from first_ggo
+        left join first_ct_chest using(d_person_id)
+        where (first_ct_chest_age is null or first_ct_chest_age >= 18)
+            and (first_ct_chest_year is null or first_ct_chest_year between 2003 and 2020)
+    ), patient_ggo_rads as (
+        select d_person_id
+        , count(distinct note_date) ggo_rads
+        from ggo_note
+        where is_radiology
+        group by d_person_id
+    ), patient_ggo_other as (
+        select d_person_id
+        , count(distinct note_date) ggo_other
+        from ggo_note
+        where not is_radiology
+        group by d_person_id
+    ), patient_rads as (
+        select d_person_id
+        , count(distinct radiology_date) rads -- consider rads reported in the same day as one
+        from radiologies
+        group by d_person_id
+    )
+    -- select *
+    select d_person_id, cohort, first_ggo_date
+    , coalesce(rads, 0) total_radiology_reports
+    , coalesce(ggo_rads, 0) radiology_reports_with_ggo
+    , coalesce(ggo_other, 0) other_reports_with_ggo
+    -- , first_scan_date, last_scan_date -- nullable
+    from cohort
+    left join patient_rads using (d_person_id)
+    left join patient_ggo_rads using (d_person_id)
+    left join patient_ggo_other using (d_person_id)
+    -- left join patient_first_last_scan using (d_person_id)
+    join v_s4_lca_cohort using (d_person_id)
+    """
+
+def build_notes_ggo_views(connection):
+    """refresh s4_persistent_cohort and s4_notes_ggo_summary (see
+    refresh.refresh_notes_ggo_summary), with their views."""
+    refresh_notes_ggo_summary(connection)
+    connection.execute(text("""create or replace view v_s4_persistent_cohort as
+    select d_person_id from s4_persistent_cohort"""))
+    connection.execute(text("""create or replace view v_s4_notes_ggo_summary as
+    select * from s4_notes_ggo_summary order by d_person_id, note_date"""))
+
+def pipeline_stages(min_days=3):
+    """return the stages of the draft.
+
+    - min_days: the number of days with an LCa ICD code of the likely cohort.
+    """
+    return [
+        dict(name='lca_cohort', reads=['cancer_diagnoses', 'person_icd_codes'],
+             produces=['s4_lca_cohort', 'v_s4_lca_cohort'],
+             run=lambda connection: build_lca_cohort(connection, min_days=min_days),
+             key=f'min_days={min_days}'),
+        dict(name='radiology_class', reads=['radiologies'],
+             produces=['s4_radiology_class', '_ct_chest'], run=build_radiology_class),
+        sql_stage('lca_dx', ['person_icd_codes', 'cancer_diagnoses', 'cancer_types'], ['_lca_dx'],
+                  [f"create or replace view _lca_dx as\n{lca_dx_sql()}"]),
+        dict(name='event_span', reads=[table for table, date in span_sources.values()],
+             produces=[f'_span_{s}' for s in span_sources] + ['s4_person_event_span'],
+             run=lambda connection: build_event_span(connection.engine)),
+        sql_stage('lca_range', ['v_s4_lca_cohort', '_lca_dx', 's4_person_event_span'], ['_lca_range'],
+                  create_table_sql('_lca_range', lca_range_sql)),
+        sql_stage('cohort_ggo_before_dx', ['notes_ggo', 'v_s4_lca_cohort', '_lca_dx'],
+                  ['_cohort_ggo_before_dx'],
+                  create_table_sql('_cohort_ggo_before_dx', cohort_ggo_before_dx_sql)),
+        sql_stage('patient_ggo', ['notes_ggo', '_ct_chest', 'radiologies', 'v_s4_lca_cohort'],
+                  ['_patient_ggo'],
+                  [f"create or replace view _patient_ggo as\n{patient_ggo_sql}"]),
+        dict(name='baselines', reads=['_cohort_ggo_before_dx', 'notes_ggo', '_lca_dx'],
+             produces=['_baseline_notes'] + [spec['name'] for spec in baseline_specs],
+             run=lambda connection: build_baselines(connection, baseline_specs),
+             key=repr(baseline_specs)),
+        dict(name='notes_ggo_summary', reads=['notes_ggo'],
+             produces=['s4_persistent_cohort', 's4_notes_ggo_summary', 's4_notes_ggo_checksum',
+                       'v_s4_persistent_cohort', 'v_s4_notes_ggo_summary'],
+             run=build_notes_ggo_views),
+    ]
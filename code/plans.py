@@ -0,0 +1,99 @@
+import json
+from datetime import datetime
+from pathlib import Path
+import numpy as np, pandas as pd
+from sqlalchemy import text
+
+# the EXPLAIN plan of the select of each stage, kept with its runtime in
+# {plan_dir}/{name}.json: the baseline (the first run, or the last accepted)
+# and the history of the runs. A new run is compared with the baseline and
+# flagged for a new full scan, a new join on a join buffer (block nested loop
+# or hash join, without index), a changed index, a blowup of the estimated
+# rows or of the runtime.
+
+def explain(connection, sql, params=None):
+    """return the mysql EXPLAIN of a select as a df, one row per table access."""
+    plan = pd.read_sql(text(f'explain {sql}'), connection, params=params)
+    plan.columns = [c.lower() for c in plan.columns]
+    return plan
+
+def _join_buffer(extra):
+    # e.g. 'Using where; Using join buffer (Block Nested Loop)' -> 'block nested loop'
+    if 'join buffer' not in extra:
+        return None
+    method = extra.split('join buffer', 1)[1].split(';')[0].strip(' ()').lower()
+    return method or 'join buffer'
+
+def plan_shape(plan):
+    """return the shape of a plan: the access type, index and join method of
+    each table, without the estimates."""
+    extra = plan.get('extra', pd.Series([''] * len(plan))).fillna('')
+    return [dict(id=int(row.id) if pd.notna(row.id) else None, table=row.table,
+                 type=row.type, key=row.key if pd.notna(row.key) else None,
+                 join_buffer=_join_buffer(e), temporary='temporary' in e,
+                 filesort='filesort' in e)
+            for row, e in zip(plan.itertuples(), extra)]
+
+def estimated_rows(plan):
+    """return the rows estimated by the plan: the product of the rows (times
+    the filtered share) of the tables joined in each select, summed."""
+    rows = plan.rows.astype('float64').fillna(1)
+    filtered = plan.get('filtered', pd.Series(100.0, index=plan.index)).astype('float64').fillna(100)
+    est = (rows * filtered / 100).clip(lower=1)
+    return float(est.groupby(plan.id.fillna(0)).prod().sum())
+
+def plan_flags(record, baseline, min_rows=10000, row_factor=10, time_factor=2):
+    """return the regressions of a plan record compared with its baseline."""
+    flags = []
+    old = {(s['id'], s['table']): s for s in baseline['shape']}
+    for s in record['shape']:
+        o = old.get((s['id'], s['table']))
+        if s['type'] == 'ALL' and record['estimated_rows'] >= min_rows and (o is None or o['type'] != 'ALL'):
+            flags.append(f"full scan of {s['table']}")
+        if s['join_buffer'] and (o is None or s['join_buffer'] != o['join_buffer']):
+            flags.append(f"join of {s['table']} on a join buffer ({s['join_buffer']})")
+        if o is not None and s['key'] != o['key']:
+            flags.append(f"index of {s['table']}: {o['key']} -> {s['key']}")
+    if record['estimated_rows'] > row_factor * max(baseline['estimated_rows'], 1):
+        flags.append(f"estimated rows: {baseline['estimated_rows']:.0f} -> {record['estimated_rows']:.0f}")
+    if (record.get('seconds') is not None and baseline.get('seconds') is not None
+            and record['seconds'] > time_factor * baseline['seconds']):
+        flags.append(f"seconds: {baseline['seconds']:.1f} -> {record['seconds']:.1f}")
+    return flags
+
+def check_plan(connection, name, sql, plan_dir, params=None, seconds=None, accept=False, **options):
+    """explain the select of a stage, record it with its runtime in seconds (if
+    known), and return its regressions compared with the baseline.
+
+    - accept: make this run the new baseline, e.g. after an intended change.
+    - options: the thresholds of plan_flags.
+    """
+    plan = explain(connection, sql, params)
+    record = dict(time=datetime.now().isoformat(), shape=plan_shape(plan),
+                  estimated_rows=estimated_rows(plan), seconds=seconds)
+    path = Path(plan_dir) / f'{name}.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    state = json.loads(path.read_text()) if path.exists() else dict(baseline=None, history=[])
+    record['flags'] = plan_flags(record, state['baseline'], **options) if state['baseline'] else []
+    if state['baseline'] is None or accept:
+        state['baseline'] = record
+    state['history'].append(record)
+    path.write_text(json.dumps(state, indent=2, default=str))
+    return record['flags']
+
+def check_plans(connection, queries, plan_dir, seconds=None, accept=False, **options):
+    """check_plan for each {name: sql or (sql, params)} of queries, with the
+    runtime of each name in seconds (e.g. the report of stages.run_stages,
+    the skipped stages with 0 seconds are not timed).
+
+    return a df of the flags of each name, empty if no regression.
+    """
+    seconds = seconds or {}
+    res = []
+    for name, query in queries.items():
+        sql, params = query if isinstance(query, tuple) else (query, None)
+        s = seconds.get(name)
+        s = None if s is None or np.isnan(s) or s == 0 else float(s)
+        for flag in check_plan(connection, name, sql, plan_dir, params, s, accept, **options):
+            res.append(dict(name=name, flag=flag))
+    return pd.DataFrame(res, columns=['name', 'flag'])
@@ -0,0 +1,110 @@
+import os, sys, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import pandas as pd
+from sqlalchemy import event
+from cache import normalize_sql
+
+# a record of every statement executed on an engine, DDL and reads alike:
+# the stage, the statement, the wall time, the rows (returned, or affected by
+# a DDL/DML, None if unknown) and the approximate bytes returned (rows x the
+# column sizes of the cursor description). The rows of a server-side cursor
+# (stream_results) are counted as they are fetched, its rowcount is not the
+# number of rows (e.g. 2**64 - 1 with pymysql).
+# The stage is the name set by query_stage, or the calling file:function.
+current_stage = ContextVar('current_stage', default=None)
+
+@contextmanager
+def query_stage(name):
+    """record the statements executed within as the stage name."""
+    token = current_stage.set(name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+def _caller():
+    # the nearest frame outside sqlalchemy, pandas and this module
+    frame = sys._getframe(1)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if not any(part in path for part in ('sqlalchemy', 'pandas', __file__)):
+            return f'{os.path.basename(path)}:{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+def _row_bytes(description):
+    return sum((col[3] if len(col) > 3 and col[3] and col[3] > 0 else 8)
+               for col in description)
+
+def _count_fetched(cursor, record):
+    # wrap the fetch methods of the cursor to add the rows fetched to record
+    def counted(fetch, many):
+        def wrapper(*args, **kwargs):
+            res = fetch(*args, **kwargs)
+            record['rows'] = (record['rows'] or 0) + (len(res) if many else res is not None)
+            record['bytes'] = record['rows'] * _row_bytes(cursor.description)
+            return res
+        return wrapper
+    try:
+        cursor.fetchone = counted(cursor.fetchone, False)
+        cursor.fetchmany = counted(cursor.fetchmany, True)
+        cursor.fetchall = counted(cursor.fetchall, True)
+    except AttributeError:
+        # a cursor of a C extension, the rows stay unknown
+        pass
+
+def instrument(engine, records=None):
+    """record the statements executed on engine into records (a list).
+
+    return records, see query_report.
+    """
+    records = [] if records is None else records
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        server_side = context is not None and context.execution_options.get('stream_results', False)
+        rows = cursor.rowcount
+        if server_side or rows is None or not 0 <= rows < 2**63:
+            rows = None
+        nbytes = None
+        if cursor.description and rows is not None:
+            nbytes = rows * _row_bytes(cursor.description)
+        record = dict(stage=current_stage.get() or _caller(),
+                      statement=normalize_sql(statement), seconds=seconds,
+                      rows=rows, bytes=nbytes)
+        records.append(record)
+        if server_side and cursor.description:
+            _count_fetched(cursor, record)
+
+    return records
+
+def _sum(values):
+    # None if unknown for all the calls
+    return values.sum(min_count=1)
+
+def query_report(records, by=('stage', 'statement'), top=None, path=None, width=120):
+    """return the statements ranked by total seconds, with their count, rows
+    and bytes, grouped by `by`; also written to path as json or csv if given."""
+    df = pd.DataFrame(records, columns=['stage', 'statement', 'seconds', 'rows', 'bytes'])
+    df['statement'] = df.statement.str.slice(0, width)
+    df['stage'] = df.stage.fillna('')
+    report = (df.groupby(list(by), sort=False)
+              .agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+                   rows=('rows', _sum), bytes=('bytes', _sum))
+              .sort_values('seconds', ascending=False))
+    report['share'] = report.seconds / report.seconds.sum()
+    if top:
+        report = report.head(top)
+    if path is not None:
+        path = str(path)
+        if path.endswith('.json'):
+            report.reset_index().to_json(path, orient='records', indent=2)
+        else:
+            report.to_csv(path)
+    return report
@@ -0,0 +1,49 @@
+from sqlalchemy import text
+from util import create_table_sql
+
+# every radiology report tagged once with a modality and a body site code,
+# in s4_radiology_class indexed on (d_person_id, radiology_date) and on
+# (modality, body_site, d_person_id, radiology_date), so that _ct_chest and
+# the other subsets are index range reads instead of like scans of radiologies.
+# The first matching pattern gives the code, 'other' if none.
+modality_patterns = [
+    ('CT', 'imaging_study', '%CT%'),
+    ('MR', 'imaging_study', '%MR%'),
+    ('PET', 'imaging_study', '%PET%'),
+    ('NM', 'imaging_study', '%Nuclear%'),
+    ('US', 'imaging_study', '%Ultrasound%'),
+    ('XR', 'imaging_study', '%X-Ray%'),
+]
+body_site_patterns = [
+    ('chest', 'location', '%Chest%'),
+    ('abdomen', 'location', '%Abdomen%'),
+    ('pelvis', 'location', '%Pelvis%'),
+    ('head', 'location', '%Head%'),
+    ('neck', 'location', '%Neck%'),
+]
+
+def class_case_sql(patterns):
+    """return the sql case of the code of the first matching pattern."""
+    whens = ''.join(f"\n    when {column} like '{pattern}' then '{code}'"
+                    for code, column, pattern in patterns)
+    return f"cast(case{whens}\n    else 'other' end as char(8))"
+
+def radiology_class_sql():
+    return f"""\
+select radiologies.*
+, {class_case_sql(modality_patterns)} modality
+, {class_case_sql(body_site_patterns)} body_site
+from radiologies"""
+
+def build_radiology_class(connection):
+    """(re)build s4_radiology_class from one scan of radiologies, and the
+    _ct_chest view over it."""
+    sqls = create_table_sql('s4_radiology_class', radiology_class_sql(),
+                            index=['d_person_id', 'radiology_date'])
+    sqls += ["""create index ix_s4_radiology_class_site
+    on s4_radiology_class (modality, body_site, d_person_id, radiology_date)""",
+             """create or replace view _ct_chest as
+    select * from s4_radiology_class
+    where modality = 'CT' and body_site = 'chest'"""]
+    for sql in sqls:
+        connection.execute(text(sql))
@@ -0,0 +1,66 @@
+from sqlalchemy import inspect, text
+from util import (notes_ggo_summary_sql, persistent_cohort_sql, notes_ggo_checksum_sql,
+                  create_table_sql)
+
+# the person level changes since the last refresh
+changed_person_sql = """\
+select n.d_person_id
+from _notes_ggo_checksum n
+left join s4_notes_ggo_checksum o
+    on o.d_person_id = n.d_person_id and o.note_date <=> n.note_date
+where o.checksum is null or o.checksum != n.checksum or o.n_rows != n.n_rows
+union
+select o.d_person_id
+from s4_notes_ggo_checksum o
+left join _notes_ggo_checksum n
+    on n.d_person_id = o.d_person_id and n.note_date <=> o.note_date
+where n.n_rows is null"""
+
+changed_notes = """(select * from notes_ggo
+    where d_person_id in (select d_person_id from _notes_ggo_changed_person))"""
+
+def build_notes_ggo_summary(connection):
+    """build s4_persistent_cohort, s4_notes_ggo_summary and the checksums of
+    notes_ggo from scratch."""
+    sqls = (create_table_sql('s4_persistent_cohort', persistent_cohort_sql(),
+                             index=['d_person_id'])
+            + create_table_sql('s4_notes_ggo_summary',
+                               notes_ggo_summary_sql(persistent='s4_persistent_cohort'),
+                               index=['d_person_id', 'note_date'])
+            + create_table_sql('s4_notes_ggo_checksum', notes_ggo_checksum_sql(),
+                               index=['d_person_id', 'note_date']))
+    for sql in sqls:
+        connection.execute(text(sql))
+
+def refresh_notes_ggo_summary(connection):
+    """refresh s4_persistent_cohort and s4_notes_ggo_summary after notes_ggo changed.
+
+    The reports of notes_ggo are compared with the checksums of the last run,
+    then only the patients with a new, changed or removed report are
+    recomputed and replaced, both their summary rows and persistent flag.
+    A first run builds everything, see build_notes_ggo_summary.
+
+    return the number of patients refreshed, or None after a full build.
+    """
+    if not inspect(connection).has_table('s4_notes_ggo_checksum'):
+        build_notes_ggo_summary(connection)
+        return None
+    sqls = (create_table_sql('_notes_ggo_checksum', notes_ggo_checksum_sql(),
+                             index=['d_person_id', 'note_date'])
+            + create_table_sql('_notes_ggo_changed_person', changed_person_sql,
+                               index=['d_person_id']))
+    sqls += [
+        """delete from s4_persistent_cohort
+        where d_person_id in (select d_person_id from _notes_ggo_changed_person)""",
+        f"insert into s4_persistent_cohort\n{persistent_cohort_sql(changed_notes)}",
+        """delete from s4_notes_ggo_summary
+        where d_person_id in (select d_person_id from _notes_ggo_changed_person)""",
+        "insert into s4_notes_ggo_summary\n"
+        + notes_ggo_summary_sql(changed_notes, persistent='s4_persistent_cohort'),
+        "drop table s4_notes_ggo_checksum",
+        "rename table _notes_ggo_checksum to s4_notes_ggo_checksum",
+    ]
+    for sql in sqls:
+        connection.execute(text(sql))
+    return connection.execute(text(
+        "select count(distinct d_person_id) from _notes_ggo_changed_person")).scalar()
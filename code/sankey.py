@@ -1,8 +1,94 @@
 import os, numpy as np, pandas as pd
-from pandasql import sqldf
 import plotly.graph_objects as go
 
-def sankey_from_person_cat_rnk(df):
+def transitions_from_person_cat_rnk(df):
+    """count the flows between consecutive ranks from a df with (person_id, cat, rnk, ..).
+
+    return a df with (src_cat, src_rnk, tgt_cat, tgt_rnk, value), the same as
+    a self join on (person_id, rnk+1) followed by a group by, without sqlite.
+
+    Note that:
+    * rnk is expected to be unique within a person_id
+    """
+    df = df.sort_values(['person_id', 'rnk'], kind='stable')
+    person_id = df.person_id.to_numpy()
+    rnk = df.rnk.to_numpy()
+    cat_codes, cats = pd.factorize(df.cat, sort=True)
+    rnk_codes, rnks = pd.factorize(rnk, sort=True)
+    n_cat = len(cats)
+
+    # a flow goes from a row to the next row of the same person with rnk+1
+    is_flow = (person_id[1:] == person_id[:-1]) & (rnk[1:] == rnk[:-1] + 1)
+    src = np.flatnonzero(is_flow)
+    tgt = src + 1
+
+    # encode (src_rnk, src_cat, tgt_cat) as one integer, tgt_rnk is src_rnk+1
+    src_node = rnk_codes[src] * n_cat + cat_codes[src]
+    value = np.bincount(src_node * n_cat + cat_codes[tgt])
+    key = np.flatnonzero(value)
+    src_node, tgt_cat = np.divmod(key, n_cat)
+    src_rnk, src_cat = np.divmod(src_node, n_cat)
+    return pd.DataFrame(dict(
+        src_cat=cats[src_cat],
+        src_rnk=rnks[src_rnk],
+        tgt_cat=cats[tgt_cat],
+        tgt_rnk=rnks[src_rnk] + 1,
+        value=value[key],
+    ))
+
+def node_ids(cat, rnk=None):
+    """map the nodes (cat, rnk) to integer ids, in a vectorized way.
+
+    The node ids are ordered by rnk, then by cat, so the same flows always
+    give the same nodes.
+
+    return (ids, label): the node id of each input, and the label of each
+    node id as '{cat}.{rnk}', or '{cat}' if no rnk.
+    """
+    cat = pd.Categorical(cat)
+    n_cat = len(cat.categories)
+    if rnk is None:
+        rnk_codes, rnks = np.zeros(len(cat), dtype=np.int64), None
+    else:
+        rnk_codes, rnks = pd.factorize(np.asarray(rnk), sort=True)
+    key = rnk_codes.astype(np.int64) * n_cat + cat.codes
+    nodes, ids = np.unique(key, return_inverse=True)
+    node_rnk, node_cat = np.divmod(nodes, n_cat)
+    node_cat = cat.categories[node_cat].astype(str)
+    if rnks is None:
+        label = list(node_cat)
+    else:
+        label = list(node_cat + '.' + pd.Index(rnks[node_rnk]).astype(str))
+    return ids.reshape(-1), label
+
+def runs_from_person_cat_rnk(df):
+    """collapse the consecutive identical cat of each person into runs.
+
+    return a df with (person_id, cat, rnk, run_length), one row per run:
+    rnk is re-ranked from 1 for each person, and run_length is the number
+    of rows collapsed into the run.
+    """
+    df = df.sort_values(['person_id', 'rnk'], kind='stable')
+    person_id = df.person_id.to_numpy()
+    cat = df.cat.to_numpy()
+    # a run starts at a new person or a new cat
+    new_person = np.ones(len(df), dtype=bool)
+    new_person[1:] = person_id[1:] != person_id[:-1]
+    new_run = new_person.copy()
+    new_run[1:] |= cat[1:] != cat[:-1]
+    start = np.flatnonzero(new_run)
+    run_length = np.diff(np.append(start, len(df)))
+    # rank the runs within each person
+    run = np.arange(len(start))
+    first_run = np.maximum.accumulate(np.where(new_person[start], run, 0))
+    return pd.DataFrame(dict(
+        person_id=person_id[start],
+        cat=cat[start],
+        rnk=run - first_run + 1,
+        run_length=run_length,
+    ))
+
+def sankey_from_person_cat_rnk(df, collapse_runs=False, **options):
     """return a sankey fig from a df with (person_id, cat, rnk, ..) preordered.
     
     - person_id: the identifier for a person, in which a flow goes.
@@ -11,103 +97,173 @@ def sankey_from_person_cat_rnk(df):
 
     Note that:
     * the person_id with only one rnk will be excluded
+    * with collapse_runs, the repeated cat of a person are collapsed first,
+      see runs_from_person_cat_rnk, so rnk is the order of the runs
+    * options are passed to sankey_fig, e.g. top_k, min_value, max_rnk
     """
-    label = [f'{c}.{r}' for c, r in set(zip(df.cat, df.rnk))]
-
-    # make src and tgt
-    src_tgt = sqldf('''
-        select src.person_id, src.cat src_cat, src.rnk src_rnk
-        , tgt.cat tgt_cat, tgt.rnk tgt_rnk
-        from df as src
-        join df as tgt on src.person_id=tgt.person_id and src.rnk+1=tgt.rnk
-        order by src.person_id, src_rnk, tgt_rnk
-        ''', locals())
-    # add value: number of persons with this flow
-    src_tgt_value = sqldf('''
-        select src_cat, src_rnk, tgt_cat, tgt_rnk
-        , count(*) value
-        from src_tgt
-        group by src_cat, src_rnk, tgt_cat, tgt_rnk
-        ''', locals())
-
-
-    label_lookup = {k: i for i, k in enumerate(label)}
-    source = [label_lookup[f'{cat}.{rnk}'] for cat, rnk in src_tgt_value[['src_cat', 'src_rnk']].values]
-    target = [label_lookup[f'{cat}.{rnk}'] for cat, rnk in src_tgt_value[['tgt_cat', 'tgt_rnk']].values]
-    value = src_tgt_value['value']
-    fig = go.Figure(data=[go.Sankey(
-        node = dict(
-          pad = 15,
-          thickness = 20,
-          line = dict(color = "black", width = 0.5),
-          label = label,
-          color = "blue"
-        ),
-        link = dict(
-          source = source,
-          target = target,
-          value = value
-      ))])
-    return fig
+    if collapse_runs:
+        df = runs_from_person_cat_rnk(df)
+    # make src and tgt, and add value: number of persons with this flow
+    src_tgt_value = transitions_from_person_cat_rnk(df)
+    return _sankey_from_transitions(src_tgt_value, **options)
 
+def transitions_from_chunks(chunks, collapse_runs=False):
+    """count the flows as transitions_from_person_cat_rnk, from an iterator of
+    df chunks with (person_id, cat, rnk, ..), e.g. pd.read_sql(..., chunksize=..).
 
-### not tested: simplified version, regardless of order
-def sankey_from_src_tgt(src_tgt):
-    src_tgt_value = sqldf.run('''
-        select src_cat, tgt_cat
-        , count(*) value
-        from src_tgt
-        group by src_cat, tgt_cat
-        ''')
-    src_tgt_value.head()
-
-    import plotly.graph_objects as go
-    label = list(set(src_tgt_value['src_cat']).union(src_tgt_value['tgt_cat']))
-    label_lookup = {k: i for i, k in enumerate(label)}
-    source = [label_lookup[cat] for cat in src_tgt_value['src_cat'].values]
-    target = [label_lookup[cat] for cat in src_tgt_value['tgt_cat'].values]
-    value = src_tgt_value['value']
-    fig = go.Figure(data=[go.Sankey(
-        node = dict(
-          pad = 15,
-          thickness = 20,
-          line = dict(color = "black", width = 0.5),
-          label = label,
-          color = "blue"
-        ),
-        link = dict(
-          source = source,
-          target = target,
-          value = value
-      ))])
-    return fig
-#fig.show()
+    Only the counts per distinct flow are kept in memory, not the rows.
 
-# not tested
-def _sankey_fig(source_names, target_names, values):
-    """build a go figure using src, trt and values.
+    Note that:
+    * the rows are expected to be ordered by (person_id, rnk) across chunks,
+      so only the last row is carried over to the next chunk.
+    * with collapse_runs, the runs are collapsed as runs_from_person_cat_rnk,
+      a run going on over a chunk boundary is merged.
     """
-    value = values
-    label = list(set(source_names) | set(target_names))
-    label_lookup = {s: i for i, s in enumerate(label)}
-    source = [label_lookup[s] for s in source_names]
-    target = [label_lookup[s] for s in target_names]
-    
-    fig = go.Figure(data=[go.Sankey(
-        node = dict(
+    key = ['src_cat', 'src_rnk', 'tgt_cat', 'tgt_rnk']
+    total, carry = None, None
+    for chunk in chunks:
+        chunk = chunk[['person_id', 'cat', 'rnk']]
+        if len(chunk) == 0:
+            continue
+        if carry is not None:
+            # the last person may go on in this chunk
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if collapse_runs:
+            chunk = runs_from_person_cat_rnk(chunk)
+            if carry is not None:
+                # go on ranking the runs of the carried person
+                same = chunk.person_id == carry.person_id.iloc[0]
+                chunk.loc[same, 'rnk'] += carry.rnk.iloc[0] - 1
+        carry = chunk.iloc[[-1]][['person_id', 'cat', 'rnk']]
+        part = transitions_from_person_cat_rnk(chunk)
+        if total is None:
+            total = part
+        else:
+            total = pd.concat([total, part]).groupby(key, as_index=False).value.sum()
+    if total is None:
+        total = transitions_from_person_cat_rnk(
+            pd.DataFrame(dict(person_id=[], cat=[], rnk=[])))
+    return total
+
+def sankey_from_chunks(chunks, collapse_runs=False, **options):
+    """return a sankey fig as sankey_from_person_cat_rnk, streaming from an
+    iterator of df chunks, see transitions_from_chunks.
+    """
+    src_tgt_value = transitions_from_chunks(chunks, collapse_runs)
+    return _sankey_from_transitions(src_tgt_value, **options)
+
+def _sankey_from_transitions(src_tgt_value, **options):
+    """build a go figure from a df with (src_cat, src_rnk, tgt_cat, tgt_rnk, value).
+    """
+    return sankey_fig(src_tgt_value.src_cat, src_tgt_value.tgt_cat, src_tgt_value.value,
+                      src_tgt_value.src_rnk, src_tgt_value.tgt_rnk, **options)
+
+def sankey_from_src_tgt(src_tgt, **options):
+    """return a sankey fig from a df with (src_cat, tgt_cat, ..), regardless of order.
+
+    Each row is one flow, options are passed to sankey_fig.
+    """
+    src_tgt_value = src_tgt.groupby(['src_cat', 'tgt_cat'], as_index=False).size()
+    return sankey_fig(src_tgt_value.src_cat, src_tgt_value.tgt_cat, src_tgt_value['size'],
+                      **options)
+
+def sankey_fig(source, target, value, source_rnk=None, target_rnk=None,
+               top_k=None, min_value=None, max_rnk=None, fixed_layout=True):
+    """build a go figure from pre-aggregated flows.
+
+    - source, target: the category names at both ends of a flow
+    - value: the number of persons with this flow
+    - source_rnk, target_rnk: the ranks at both ends, if the flows are ordered
+
+    The flows can be pruned before plotting, to keep large figures small:
+    - max_rnk: drop the flows going beyond this rank (ordered flows only)
+    - min_value: merge the nodes (category and rank) with a smaller flow into
+      an 'other' node of their rank, on both ends of their flows
+    - top_k: keep only the k largest flows
+
+    For ordered flows, the nodes are placed in one column per rank by default
+    (fixed_layout), instead of leaving the layout to the browser.
+    """
+    flows = pd.DataFrame(dict(
+        src_cat=np.asarray(source), tgt_cat=np.asarray(target), value=np.asarray(value)))
+    key = ['src_cat', 'tgt_cat']
+    if source_rnk is not None:
+        flows = flows.assign(src_rnk=np.asarray(source_rnk), tgt_rnk=np.asarray(target_rnk))
+        key = ['src_cat', 'src_rnk', 'tgt_cat', 'tgt_rnk']
+        if max_rnk is not None:
+            flows = flows[flows.tgt_rnk <= max_rnk]
+    if min_value is not None:
+        flows = _merge_small_nodes(flows, key, min_value)
+    if top_k is not None:
+        flows = flows.sort_values('value', ascending=False, kind='stable').head(top_k)
+
+    n = len(flows)
+    ids, label = node_ids(
+        np.concatenate([flows.src_cat, flows.tgt_cat]),
+        None if source_rnk is None else np.concatenate([flows.src_rnk, flows.tgt_rnk]))
+    source, target = ids[:n], ids[n:]
+    node = dict(
           pad = 15,
           thickness = 20,
           line = dict(color = "black", width = 0.5),
           label = label,
           color = "blue"
-        ),
+        )
+    arrangement = 'snap'
+    if source_rnk is not None and fixed_layout and n > 0:
+        node_rnk = np.empty(len(label), dtype=flows.src_rnk.dtype)
+        node_rnk[ids] = np.concatenate([flows.src_rnk, flows.tgt_rnk])
+        size = np.maximum(np.bincount(source, flows.value, minlength=len(label)),
+                          np.bincount(target, flows.value, minlength=len(label)))
+        node['x'], node['y'] = _rank_layout(node_rnk, size)
+        arrangement = 'fixed'
+    fig = go.Figure(data=[go.Sankey(
+        arrangement = arrangement,
+        node = node,
         link = dict(
           source = source,
           target = target,
-          value = value
+          value = flows.value
       ))])
     return fig
 
+def _merge_small_nodes(flows, key, min_value):
+    """relabel the nodes with a flow (the max of in and out) below min_value
+    to 'other' at both ends of the flows, then re-aggregate, so the flows in
+    and out of each node still balance."""
+    ends = [[f'{end}_cat', f'{end}_rnk'] for end in ('src', 'tgt')]
+    # the unordered flows have the same node at any rank
+    rnk = flows.assign(src_rnk=0, tgt_rnk=0) if 'src_rnk' not in flows else flows
+    size = pd.concat([rnk.groupby(cols).value.sum().rename_axis(['cat', 'rnk'])
+                      for cols in ends], axis=1).max(axis=1)
+    small = size.index[size < min_value]
+    for cat, rnk_col in ends:
+        is_small = pd.MultiIndex.from_frame(rnk[[cat, rnk_col]]).isin(small)
+        flows = flows.assign(**{cat: flows[cat].where(~is_small, 'other')})
+    return flows.groupby(key, as_index=False, sort=False).value.sum()
+
+def _rank_layout(node_rnk, size, pad=0.05, margin=0.01):
+    """return the node (x, y) for a layout of one column per rank.
+
+    - node_rnk: the rank of each node id, the ids ordered by rank then category
+    - size: the flow size of each node
+    - pad: the gap between two nodes, as a fraction of the tallest column
+
+    The nodes in a column are stacked in the id order, i.e. the category order.
+    """
+    col, cols = pd.factorize(node_rnk, sort=True)
+    x = col / max(len(cols) - 1, 1)
+    # the ids of a column are contiguous, so stack them with a cumsum
+    first = np.searchsorted(col, np.arange(len(cols)))
+    below = np.cumsum(size) - size
+    below = below - below[first][col]
+    index = np.arange(len(col)) - first[col]
+    total = np.bincount(col, size)
+    gap = pad * total.max()
+    height = total + gap * (np.bincount(col) - 1)
+    y = (below + gap * index + size / 2) / (height.max() or 1)
+    return margin + (1 - 2 * margin) * x, margin + (1 - 2 * margin) * y
+
 def _test_sankey_fig():
     fig = sankey_fig(['a', 'b', 'b'], ['b', 'a', 'b'], [1, 2, 3])
     fig.show()
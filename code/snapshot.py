@@ -0,0 +1,149 @@
+import hashlib, json, shutil
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+from sqlalchemy import bindparam, inspect, text
+from util import arrow_schema
+
+# local parquet snapshots of the source tables, one per database refresh:
+# {snapshot_dir}/{version}/{table}/bucket=../part-...parquet, partitioned by d_person_id
+source_tables = ['notes_ggo', 'radiologies', 'person_icd_codes', 'visits',
+                 'procedure_occurrences', 'medications', 'cancer_diagnoses']
+
+# the change stamp of a table is its last entry in the refresh log, written by
+# log_refresh when the table is loaded or built (stages.run_stages does it for
+# the tables it builds, synth.load_tables for the tables it loads), together
+# with its status in information_schema (create and update time, rows, data
+# length, auto_increment), read fresh from the storage engine rather than the
+# statistics cached for information_schema_stats_expiry. Both are cheap, and
+# the status changes with the data even if a refresh did not log the table;
+# an update_time reset by a server restart only misses the cache once.
+# The stamps of the source tables are taken once per session (source_stamps)
+# and passed on to the cache, the snapshot and the stages.
+refresh_log = 's4_refresh_log'
+
+def log_refresh(connection, tables):
+    """record in the refresh log that the tables were just loaded or built.
+
+    return the stamp recorded.
+    """
+    stamp = datetime.now().isoformat()
+    connection.execute(text(f"""create table if not exists {refresh_log} (
+        table_name varchar(64) primary key, refreshed_at varchar(32) not null)"""))
+    for table in tables:
+        # delete and insert rather than replace into, not in duckdb
+        connection.execute(text(f"delete from {refresh_log} where table_name = :table"),
+                           dict(table=table))
+        connection.execute(text(f"insert into {refresh_log} values (:table, :stamp)"),
+                           dict(table=table, stamp=stamp))
+    return stamp
+
+def _table_status(connection, tables):
+    # {table: its status} of the base tables, mysql only
+    if connection.dialect.name != 'mysql':
+        return {}
+    connection.execute(text("set session information_schema_stats_expiry = 0"))
+    rows = connection.execute(text("""
+        select table_name, create_time, update_time, table_rows, data_length, auto_increment
+        from information_schema.tables
+        where table_schema = database() and table_type = 'BASE TABLE' and table_name in :tables
+        """).bindparams(bindparam('tables', expanding=True)), dict(tables=tables))
+    return {name: '/'.join(map(str, status)) for name, *status in rows}
+
+def table_stamps(connection, tables, stamps=None):
+    """return {table: change stamp} of the tables, None if unknown (e.g. a
+    missing table, or a view not in the refresh log).
+
+    - stamps: the stamps already taken, e.g. source_stamps, not read again.
+    """
+    tables = list(tables)
+    known = {table: stamps[table] for table in tables if table in (stamps or {})}
+    todo = [table for table in tables if table not in known]
+    logged = {}
+    if todo and inspect(connection).has_table(refresh_log):
+        rows = connection.execute(
+            text(f"select table_name, refreshed_at from {refresh_log} where table_name in :tables")
+            .bindparams(bindparam('tables', expanding=True)), dict(tables=todo))
+        logged = dict(rows.fetchall())
+    status = _table_status(connection, todo) if todo else {}
+    for table in todo:
+        parts = [part for part in (logged.get(table), status.get(table)) if part is not None]
+        known[table] = '|'.join(parts) if parts else None
+    return {table: known[table] for table in tables}
+
+def source_stamps(connection, tables=source_tables):
+    """return the stamps of the source tables, to take once per session."""
+    return table_stamps(connection, tables)
+
+def source_version(connection, tables=source_tables, stamps=None):
+    """return the version of the tables in the database, a hash of their change
+    stamps, or None if unknown.
+
+    - stamps: the stamps already taken, see table_stamps.
+    """
+    stamps = table_stamps(connection, tables, stamps)
+    if None in stamps.values():
+        return None
+    key = repr(sorted(stamps.items()))
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def take_snapshot(connection, snapshot_dir, tables=source_tables, version=None,
+                  buckets=16, chunksize=500000, stamps=None):
+    """pull the tables from the database into a local snapshot, unless the
+    snapshot of this version is already there.
+
+    - version: the snapshot key, source_version by default (of the stamps if given).
+    - buckets: the number of partitions by d_person_id of each table.
+
+    return the path of the snapshot, or None if the version is unknown (no
+    snapshot is pulled, as it could not be told apart from the next one).
+    """
+    import pyarrow as pa, pyarrow.dataset as ds
+    version = version or source_version(connection, tables, stamps)
+    if version is None:
+        return None
+    path = Path(snapshot_dir) / version
+    if (path / 'manifest.json').exists():
+        return path
+    # a snapshot without manifest is incomplete
+    shutil.rmtree(path, ignore_errors=True)
+    rows = {}
+    for table in tables:
+        chunks = pd.read_sql(f'select * from {table}',
+                             connection.execution_options(stream_results=True),
+                             chunksize=chunksize)
+        # the schema of the table, a column can be all null in a chunk
+        rows[table], schema = 0, arrow_schema(connection, table, extra={'bucket': pa.int64()})
+        for i, chunk in enumerate(chunks):
+            chunk = chunk.assign(bucket=chunk.d_person_id % buckets)
+            data = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            ds.write_dataset(data, path / table, format='parquet',
+                             partitioning=['bucket'], partitioning_flavor='hive',
+                             basename_template=f'part-{i:05d}-{{i}}.parquet',
+                             existing_data_behavior='overwrite_or_ignore')
+            rows[table] += len(chunk)
+    manifest = dict(version=version, buckets=buckets, rows=rows,
+                    created=datetime.now().isoformat())
+    (path / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return path
+
+def latest_snapshot(snapshot_dir):
+    """return the version of the latest complete snapshot, or None."""
+    manifests = [json.loads(p.read_text()) for p in Path(snapshot_dir).glob('*/manifest.json')]
+    return max(manifests, key=lambda m: m['created'])['version'] if manifests else None
+
+def read_snapshot(table, snapshot_dir, version=None, columns=None, persons=None):
+    """read a table from a local snapshot, the latest one by default.
+
+    - columns: the columns to read, all by default.
+    - persons: the d_person_id to read, all by default; only their partitions are read.
+    """
+    path = Path(snapshot_dir) / (version or latest_snapshot(snapshot_dir))
+    filters = None
+    if persons is not None:
+        buckets = json.loads((path / 'manifest.json').read_text())['buckets']
+        persons = list(set(persons))
+        filters = [('bucket', 'in', sorted({p % buckets for p in persons})),
+                   ('d_person_id', 'in', persons)]
+    df = pd.read_parquet(path / table, columns=columns, filters=filters)
+    return df.drop(columns='bucket', errors='ignore')
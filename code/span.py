@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+
+# the first and last event date of each person, per source table and overall,
+# kept in small tables instead of scanning the event tables for each use:
+# _span_{source} (d_person_id, first_{source}, last_{source}) and s4_person_event_span
+span_sources = {
+    'visit': ('visits', 'visit_date'),
+    'dx': ('person_icd_codes', 'event_date'),
+    'proc': ('procedure_occurrences', 'procedure_date'),
+    'med': ('medications', 'date_of_medication'),
+}
+
+def source_span_sql(source, where=None):
+    """return the sql of the first and last event date of each person in a source,
+    optionally only for the events matching where."""
+    table, date = span_sources[source]
+    where = f'\nwhere {where}' if where else ''
+    return f"""\
+select d_person_id, min({date}) first_{source}, max({date}) last_{source}
+from {table}{where}
+group by d_person_id"""
+
+def event_span_sql(sources=span_sources):
+    """return the sql combining the source spans into the overall span of each person."""
+    persons = '\n    union '.join(f'select d_person_id from _span_{s}' for s in sources)
+    joins = '\n'.join(f'left join _span_{s} using (d_person_id)' for s in sources)
+    columns = ''.join(f'\n, first_{s}, last_{s}' for s in sources)
+    first = ', '.join(f'coalesce(first_{s}, 99999)' for s in sources)
+    last = ', '.join(f'coalesce(last_{s}, 0)' for s in sources)
+    return f"""\
+select d_person_id{columns}
+, nullif(least({first}), 99999) first_event_date
+, nullif(greatest({last}), 0) last_event_date
+from (
+    {persons}
+) as persons
+{joins}"""
+
+def build_source_span(engine, source):
+    """(re)build the span table of a source, on its own connection."""
+    with engine.begin() as connection:
+        connection.execute(text(f"drop table if exists _span_{source}"))
+        connection.execute(text(f"""create table _span_{source} (primary key (d_person_id)) as
+{source_span_sql(source)}"""))
+
+def build_event_span(engine, sources=span_sources, workers=4):
+    """build the span tables of all sources in parallel, then s4_person_event_span."""
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda s: build_source_span(engine, s), sources))
+    combine_event_span(engine, sources)
+
+def update_source_span(engine, source, where):
+    """merge the new events of a source (matching where, e.g. a date or id
+    after the last update) into its span table, then s4_person_event_span.
+
+    The spans only grow, so the removed events are not taken into account,
+    rebuild with build_event_span then.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(f"""insert into _span_{source}
+{source_span_sql(source, where)}
+on duplicate key update
+    first_{source} = least(coalesce(first_{source}, values(first_{source})),
+                           coalesce(values(first_{source}), first_{source})),
+    last_{source} = greatest(coalesce(last_{source}, values(last_{source})),
+                             coalesce(values(last_{source}), last_{source}))"""))
+    combine_event_span(engine)
+
+def combine_event_span(engine, sources=span_sources):
+    with engine.begin() as connection:
+        connection.execute(text("drop table if exists s4_person_event_span"))
+        connection.execute(text(f"""create table s4_person_event_span (primary key (d_person_id)) as
+{event_span_sql(sources)}"""))
@@ -0,0 +1,125 @@
+import json, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import pandas as pd
+from sqlalchemy import inspect, text
+from querylog import query_stage
+from snapshot import log_refresh, table_stamps
+
+# the analysis tables as stages run in dependency order, each stage a dict:
+# * name: the stage name
+# * reads: the tables (or views) it reads
+# * produces: the tables (or views) it creates
+# * run: a function of a connection building the produced tables
+# * key: optional, what else the tables depend on, e.g. their sql or parameters
+# A stage runs after the stages producing what it reads, the independent
+# stages run concurrently on their own connection, and a stage is skipped if
+# its inputs (and key) did not change since its last run (the state is kept in a json file).
+# The tables built by a stage are recorded in the refresh log, their stamp is
+# the input version of the stages reading them.
+
+def sql_stage(name, reads, produces, sqls):
+    """return a stage executing the sql statements in order."""
+    def run(connection):
+        for sql in sqls:
+            connection.execute(text(sql))
+    return dict(name=name, reads=list(reads), produces=list(produces), run=run,
+                key='\n'.join(sqls))
+
+def table_versions(connection, tables, stamps=None):
+    """return {table: version} of the existing tables (or views), as their
+    change stamp (see snapshot.table_stamps), None if unknown.
+
+    - stamps: the stamps already taken, e.g. snapshot.source_stamps.
+    """
+    insp = inspect(connection)
+    names = set(insp.get_table_names()) | set(insp.get_view_names())
+    tables = [table for table in tables if table in names]
+    return table_stamps(connection, tables, stamps) if tables else {}
+
+def stage_order(stages):
+    """return {stage name: the names of the stages it depends on}, or raise a
+    ValueError on a cycle or a table produced twice."""
+    producer = {}
+    for stage in stages:
+        for table in stage['produces']:
+            if table in producer:
+                raise ValueError(f"{table} is produced by {producer[table]} and {stage['name']}")
+            producer[table] = stage['name']
+    deps = {stage['name']: {producer[t] for t in stage['reads'] if t in producer} - {stage['name']}
+            for stage in stages}
+    done, todo = set(), dict(deps)
+    while todo:
+        ready = [name for name, d in todo.items() if d <= done]
+        if not ready:
+            raise ValueError(f'cycle between the stages: {sorted(todo)}')
+        done.update(ready)
+        for name in ready:
+            del todo[name]
+    return deps
+
+def run_stages(engine, stages, state_path, workers=4, force=False, stamps=None):
+    """run the stages whose inputs changed since their last run, concurrently
+    when they are independent.
+
+    - state_path: the json file of the input versions of the last runs.
+    - force: run all the stages, e.g. after a change of the code of a stage run function.
+    - stamps: the stamps already taken of some tables, e.g. snapshot.source_stamps.
+
+    return a df of the status (ran, skipped) and seconds of each stage.
+    """
+    deps = stage_order(stages)
+    by_name = {stage['name']: stage for stage in stages}
+    produced = {t for stage in stages for t in stage['produces']}
+    state_path = Path(state_path)
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    # the versions of the tables, updated as the stages run
+    with engine.connect() as connection:
+        versions = table_versions(connection, sorted({t for stage in stages for t in stage['reads']}
+                                                     | produced), stamps)
+    existing = set(versions)
+
+    def inputs(stage):
+        return dict(tables={t: versions.get(t) for t in stage['reads']}, key=stage.get('key'))
+
+    def run(stage):
+        start = time.perf_counter()
+        with query_stage(stage['name']), engine.begin() as connection:
+            stage['run'](connection)
+            log_refresh(connection, stage['produces'])
+        # stamped once committed, as read by the next runs
+        with engine.connect() as connection:
+            stamps = table_stamps(connection, stage['produces'])
+        return time.perf_counter() - start, stamps
+
+    report, status = {}, {}
+    with ThreadPoolExecutor(workers) as pool:
+        running = {}
+        while len(status) < len(stages):
+            for name, d in deps.items():
+                if name in status or name in running.values() or not d <= set(status):
+                    continue
+                stage = by_name[name]
+                stage_inputs = inputs(stage)
+                last = state.get('stages', {}).get(name)
+                if (not force and last is not None and last == stage_inputs
+                        and None not in stage_inputs['tables'].values()
+                        and set(stage['produces']) <= existing):
+                    status[name] = 'skipped'
+                    report[name] = dict(status='skipped', seconds=0.0)
+                    continue
+                running[pool.submit(run, stage)] = name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                seconds, stamps = future.result()
+                stage = by_name[name]
+                state.setdefault('stages', {})[name] = inputs(stage)
+                versions.update(stamps)
+                existing.update(stage['produces'])
+                status[name] = 'ran'
+                report[name] = dict(status='ran', seconds=seconds)
+                state_path.write_text(json.dumps(state, indent=2))
+    return pd.DataFrame.from_dict(report, orient='index').reindex([s['name'] for s in stages])
@@ -0,0 +1,129 @@
+import numpy as np, pandas as pd
+from sqlalchemy import text
+from snapshot import log_refresh
+
+# synthetic EHR tables with the columns used by the analysis, to measure the
+# performance without the real database, e.g. synthetic_ehr(100000) then
+# load_tables(tables, create_engine('sqlite:///synth.db')).
+# The dates are in days (of age, as in the source tables), with the years
+# between 2000 and 2022; a share of the patients has lung cancer (ICD C34/162
+# codes, confirmed or not) and a share of them GGO reports.
+ggo_levels = {
+    'GGO_term': ['pure', 'mixed'],
+    'GGO_size': ['<6mm(0.6cm)', '6-20mm(0.6-2cm)', '>20mm(2cm)'],
+    'GGO_location': ['right upper lobe', 'right lower lobe', 'left upper lobe', 'left lower lobe'],
+    'GGO_number': ['single', 'multiple'],
+    'GGO_shape_margin': ['round', 'irregular', 'spiculated'],
+    'GGO_solidity': ['stable', 'increased', 'decreased'],
+    'GGO_status_change': ['resolved/disappeared', 'decreased/improved/reduced/shrink',
+                          'stable/no change/persistent', 'increased/progressed'],
+    'GGO_potential_cause': ['infectious_inflammatory', 'other', 'malignant neoplasm',
+                            'premalignancy'],
+}
+imaging_studies = ['CT', 'CT with contrast', 'MRI', 'PET/CT', 'X-Ray', 'Ultrasound']
+locations = ['Chest', 'Abdomen', 'Pelvis', 'Head', 'Neck']
+other_icd_codes = ['E11.9', 'I10', 'J44.9', 'J18.9', 'R91.8', 'Z87.891', '250.00', '401.9']
+
+def _events(rng, person_id, start, span, mean):
+    # a lognormal number of events per person, dated within its follow-up
+    n = rng.poisson(mean * rng.lognormal(0, 0.75, len(person_id)))
+    ids = np.repeat(person_id, n)
+    dates = np.repeat(start, n) + (rng.random(n.sum()) * np.repeat(span, n)).astype('int32')
+    return ids, dates
+
+def _year(dates, birth_year):
+    return (birth_year + dates // 365.25).astype('int32')
+
+def synthetic_ehr(n_patients, seed=0, lca_rate=0.05, ggo_rate=0.3, events_per_year=4):
+    """return {table: df} of the synthetic notes_ggo, radiologies, person_icd_codes,
+    cancer_diagnoses, cancer_types, visits, procedure_occurrences and medications
+    of n_patients."""
+    rng = np.random.default_rng(seed)
+    person_id = np.arange(1, n_patients + 1, dtype='int64')
+    birth_year = rng.integers(1920, 1990, n_patients)
+    # the follow-up in days of age, within 2000-2022
+    first_year = rng.integers(2000, 2020, n_patients)
+    start = ((first_year - birth_year) * 365.25).astype('int32')
+    span = (rng.integers(1, 2023 - first_year + 1) * 365.25).astype('int32')
+    years = span / 365.25
+    to_year = lambda ids, dates: _year(dates, birth_year[ids - 1])
+
+    tables = {}
+    ids, dates = _events(rng, person_id, start, span, events_per_year * years)
+    tables['visits'] = pd.DataFrame(dict(d_person_id=ids, visit_date=dates))
+    ids, dates = _events(rng, person_id, start, span, 2 * years)
+    tables['procedure_occurrences'] = pd.DataFrame(dict(
+        d_person_id=ids, procedure_date=dates,
+        procedure_code=rng.choice(['71250', '71260', '71270', 'G0297', '99213'], len(ids))))
+    ids, dates = _events(rng, person_id, start, span, 3 * years)
+    tables['medications'] = pd.DataFrame(dict(d_person_id=ids, date_of_medication=dates))
+
+    # lung cancer: an ICD code on some days, confirmed for a part of them
+    is_lca = rng.random(n_patients) < lca_rate
+    lca_id = person_id[is_lca]
+    lca_dx = start[is_lca] + (rng.random(is_lca.sum()) * span[is_lca]).astype('int32')
+    ids, dates = _events(rng, person_id, start, span, 2 * years)
+    lca_ids, lca_dates = _events(rng, lca_id, lca_dx, np.maximum(span[is_lca] // 4, 1), 4)
+    icd = np.concatenate([rng.choice(other_icd_codes, len(ids)),
+                          rng.choice(['C34.90', 'C34.11', 'C34.31', '162.9'], len(lca_ids))])
+    ids, dates = np.concatenate([ids, lca_ids]), np.concatenate([dates, lca_dates])
+    tables['person_icd_codes'] = pd.DataFrame(dict(
+        d_person_id=ids, icd_code=icd, event_date=dates, year_event_date=to_year(ids, dates)))
+    confirmed = rng.random(len(lca_id)) < 0.6
+    other_id = person_id[rng.random(n_patients) < 0.02]
+    ids = np.concatenate([lca_id[confirmed], other_id])
+    dates = np.concatenate([lca_dx[confirmed], start[other_id - 1]])
+    tables['cancer_diagnoses'] = pd.DataFrame(dict(
+        d_person_id=ids, cancer_type_id=np.r_[np.ones(confirmed.sum(), 'int64'),
+                                              rng.integers(2, 6, len(other_id))],
+        date_of_diagnosis=dates, year_of_diagnosis=to_year(ids, dates)))
+    tables['cancer_types'] = pd.DataFrame(dict(
+        cancer_type_id=[1, 2, 3, 4, 5], cancer_type_name=['LCA', 'BRCA', 'CRC', 'PRAD', 'OTHER']))
+
+    ids, dates = _events(rng, person_id, start, span, 1 * years)
+    radiology_id = np.arange(1, len(ids) + 1, dtype='int64')
+    tables['radiologies'] = pd.DataFrame(dict(
+        radiology_id=radiology_id, d_person_id=ids, radiology_date=dates,
+        year_radiology_date=to_year(ids, dates),
+        imaging_study=rng.choice(imaging_studies, len(ids), p=[.3, .1, .15, .05, .3, .1]),
+        location=rng.choice(locations, len(ids), p=[.5, .2, .1, .1, .1])))
+
+    # GGO reports: some radiologies (and a few other notes) of a share of the
+    # patients, more often for lung cancer, with a few GGO levels each
+    has_ggo = rng.random(n_patients) < np.where(is_lca, 0.5, ggo_rate * 0.1)
+    rad = tables['radiologies']
+    rad = rad[has_ggo[rad.d_person_id.to_numpy() - 1] & (rng.random(len(rad)) < 0.5)]
+    note_id = np.concatenate([rad.d_person_id.to_numpy(), rad.d_person_id.to_numpy()[:len(rad) // 10]])
+    note_date = np.concatenate([rad.radiology_date.to_numpy(),
+                                rad.radiology_date.to_numpy()[:len(rad) // 10] + 1])
+    note_rad = np.concatenate([rad.radiology_id.to_numpy().astype('float64'),
+                               np.full(len(rad) // 10, np.nan)])
+    level1s = np.array(list(ggo_levels))
+    n = 1 + rng.poisson(3, len(note_id))
+    level1 = level1s[(np.repeat(rng.integers(0, len(level1s), len(note_id)), n)
+                      + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) % len(level1s)]
+    level1[np.cumsum(n) - n] = 'GGO_term'
+    level2 = np.empty(len(level1), dtype=object)
+    for name, values in ggo_levels.items():
+        mask = level1 == name
+        level2[mask] = rng.choice(values, mask.sum())
+    level3 = np.full(len(level1), None, dtype=object)
+    size = level1 == 'GGO_size'
+    level3[size] = np.round(rng.lognormal(2, 0.7, size.sum()), 1).astype(str)
+    location = level1 == 'GGO_location'
+    level3[location] = rng.choice(['upper', 'lower', 'other'], location.sum())
+    tables['notes_ggo'] = pd.DataFrame(dict(
+        d_person_id=np.repeat(note_id, n), note_date=np.repeat(note_date, n),
+        radiology_id=pd.array(np.repeat(note_rad, n), dtype='Int64'),
+        ggo_level1=level1, ggo_level2=level2, ggo_level3=level3))
+    return tables
+
+def load_tables(tables, connection, indexes=True, chunksize=100000):
+    """write the tables into a database (sqlite, duckdb or mysql through
+    sqlalchemy), replacing them, with an index on d_person_id, then log the
+    refresh of the tables (see snapshot.log_refresh)."""
+    for name, df in tables.items():
+        df.to_sql(name, connection, if_exists='replace', index=False, chunksize=chunksize)
+        if indexes and 'd_person_id' in df:
+            connection.execute(text(f'create index ix_{name}_person on {name} (d_person_id)'))
+    log_refresh(connection, list(tables))
@@ -1,3 +1,5 @@
+import pandas as pd
+
 def left_join_person_date(alias, level1, agg):
     return f"""\
 left join (
@@ -27,3 +29,146 @@ left join (
 order by d_person_id, note_date
 """
     print (sql)
+
+ggo_venn_levels = ['GGO_potential_cause', 'GGO_size', 'GGO_location', 'GGO_number',
+                   'GGO_shape_margin', 'GGO_term', 'GGO_solidity', 'GGO_status_change']
+
+def level_person_sql(level1s=ggo_venn_levels):
+    """return the sql of the distinct (ggo_level1, ggo_level2, d_person_id)
+    of notes_ggo, for all the level1s in one scan."""
+    level1s = ', '.join(f"'{level1}'" for level1 in level1s)
+    return f"""\
+select ggo_level1, ggo_level2, d_person_id
+from notes_ggo
+where ggo_level1 in ({level1s}) and ggo_level2 is not null
+group by ggo_level1, ggo_level2, d_person_id"""
+
+def level_person_sets(df):
+    """fan out a df with (ggo_level1, ggo_level2, d_person_id) into
+    {ggo_level1: {ggo_level2: set of d_person_id}}, as the input of venn.venn."""
+    sets = {}
+    for (level1, level2), x in df.groupby(['ggo_level1', 'ggo_level2'], observed=True):
+        sets.setdefault(level1, {})[level2] = set(x.d_person_id)
+    return sets
+
+def level_patient_counts(sets, level1):
+    """return the number of patients for each ggo_level2 of a level1 in sets."""
+    return pd.Series({level2: len(persons) for level2, persons in sets[level1].items()},
+                     name='patients').rename_axis(level1)
+
+def when_level1(level1, expr='ggo_level2'):
+    return f"case when ggo_level1='{level1}' then {expr} end"
+
+def concat_level1(alias, level1, expr='ggo_level2', dialect='mysql'):
+    """return the sql aggregate of the distinct values of expr for level1,
+    sorted and joined by ', ', for the dialect (on sqlite, the sorted_concat
+    aggregate of bench.sqlite_functions)."""
+    expr = when_level1(level1, expr)
+    if dialect == 'sqlite':
+        return f"sorted_concat(distinct {expr}) as {alias}"
+    if dialect in ('duckdb', 'postgresql'):
+        return f"string_agg(distinct {expr}, ', ' order by {expr}) as {alias}"
+    return f"group_concat(distinct {expr} order by {expr} separator ', ') as {alias}"
+
+def notes_ggo_summary_sql(source='notes_ggo', persistent='v_s4_persistent_cohort', dialect='mysql'):
+    """return the sql of the report level summary, the same columns as the
+    left joins of left_join_person_date, but in one grouped scan of source
+    with conditional aggregation.
+
+    - dialect: the database of the sql, see concat_level1.
+    """
+    location = "concat(COALESCE(ggo_level2, '_'), '::', COALESCE(ggo_level3, '_'))"
+    aggs = [
+        concat_level1('term_types', 'GGO_term', dialect=dialect),
+        f"max({when_level1('GGO_size', 'cast(ggo_level3 as decimal)')}) as max_size",
+        concat_level1('locations', 'GGO_location', location, dialect=dialect),
+        concat_level1('potential_causes', 'GGO_potential_cause', dialect=dialect),
+        concat_level1('shape_margins', 'GGO_shape_margin', dialect=dialect),
+        concat_level1('solidity_changes', 'GGO_solidity', dialect=dialect),
+        concat_level1('numbers', 'GGO_number', dialect=dialect),
+        concat_level1('status_changes', 'GGO_status_change', dialect=dialect),
+    ]
+    aggs = '\n    , '.join(aggs)
+    return f"""\
+select *
+from (
+    select d_person_id, note_date
+    , {aggs}
+    from {source} as notes
+    group by d_person_id, note_date
+) as note_info
+left join (
+    select d_person_id, 'Yes' as is_persistent
+    from {persistent}
+) as persistent using (d_person_id)"""
+
+def persistent_cohort_sql(source='notes_ggo'):
+    """return the sql of the persistent GGO cohort from source, in one pass
+    over the latest report of each patient:
+    * patients with multiple reports, except those with resolved on the latest one
+    * or patients with one report, with a stable or worsened status on it
+    """
+    return f"""\
+with dates as (
+    select d_person_id, count(distinct note_date) as date_count, max(note_date) as note_date
+    from {source} as notes
+    group by d_person_id
+), latest as (
+    select d_person_id, date_count
+    , coalesce(max(ggo_level1 = 'GGO_status_change' and ggo_level2 = 'resolved/disappeared'), 0) as resolved
+    , coalesce(max((ggo_level1 = 'GGO_status_change' and ggo_level2 in ('stable/no change/persistent', 'increased/progressed'))
+        or (ggo_level1 = 'GGO_solidity' and ggo_level2 in ('stable', 'increased'))), 0) as changed
+    from {source} as notes
+    join dates using (d_person_id, note_date)
+    group by d_person_id, date_count
+)
+select d_person_id
+from latest
+where (date_count > 1 and not resolved)
+    or (date_count = 1 and changed)"""
+
+def notes_ggo_checksum_sql(source='notes_ggo'):
+    """return the sql of a checksum for each (d_person_id, note_date) of source,
+    to find the reports changed since the last refresh; a sum of the row crc32,
+    so that a duplicated row changes it (a bit_xor would cancel out)."""
+    return f"""\
+select d_person_id, note_date, count(*) as n_rows
+, sum(crc32(concat_ws('|', ggo_level1, coalesce(ggo_level2, ''), coalesce(ggo_level3, '')))) as checksum
+from {source} as notes
+group by d_person_id, note_date"""
+
+def create_table_sql(tablename, query, index=None):
+    """return the statements to (re)create tablename from query, with an index
+    on the index columns, e.g. to materialize a view."""
+    sqls = [f"drop table if exists {tablename}",
+            f"create table {tablename} as\n{query}"]
+    if index:
+        sqls.append(f"create index ix_{tablename} on {tablename} ({', '.join(index)})")
+    return sqls
+
+def arrow_schema(connection, table_name, extra=None):
+    """return the pyarrow schema of a table from its definition in the database,
+    for the chunks of pd.read_sql (a column can be all null in a chunk).
+
+    - extra: {name: pyarrow type} of the columns added to the chunks.
+    """
+    import datetime, decimal
+    import pyarrow as pa
+    from sqlalchemy import inspect
+    types = {int: pa.int64(), float: pa.float64(), decimal.Decimal: pa.float64(),
+             bool: pa.bool_(), str: pa.string(), bytes: pa.binary(),
+             datetime.date: pa.date32(), datetime.datetime: pa.timestamp('us'),
+             datetime.timedelta: pa.duration('us')}
+    fields = []
+    for column in inspect(connection).get_columns(table_name):
+        try:
+            python_type = column['type'].python_type
+        except NotImplementedError:
+            python_type = str
+        fields.append((column['name'], types.get(python_type, pa.string())))
+    return pa.schema(fields + list((extra or {}).items()))
+
+def test_notes_ggo_summary():
+    for sql in create_table_sql('s4_notes_ggo_summary', notes_ggo_summary_sql(),
+                                index=['d_person_id', 'note_date']):
+        print(sql)
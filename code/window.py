@@ -0,0 +1,69 @@
+import numpy as np, pandas as pd
+
+# temporal joins of events near an index date, within each person:
+# both sides are sorted by (person, date) once, then matched in order,
+# instead of comparing every pair of events of a person in sql.
+
+def nearest_after(left, right, left_on, right_on, by='d_person_id',
+                  allow_exact_matches=False, tolerance=None):
+    """join each left row to the first right row of the same `by` after it,
+    e.g. the first CT after the first GGO date.
+
+    The left rows without any right row after are dropped.
+    """
+    return _nearest(left, right, left_on, right_on, by, 'forward',
+                    allow_exact_matches, tolerance)
+
+def nearest_before(left, right, left_on, right_on, by='d_person_id',
+                   allow_exact_matches=False, tolerance=None):
+    """join each left row to the last right row of the same `by` before it.
+
+    The left rows without any right row before are dropped.
+    """
+    return _nearest(left, right, left_on, right_on, by, 'backward',
+                    allow_exact_matches, tolerance)
+
+def _nearest(left, right, left_on, right_on, by, direction, allow_exact_matches, tolerance):
+    # merge_asof needs the same dtype and no null on both keys
+    left = left.dropna(subset=[left_on]).astype({left_on: 'float64'}).sort_values(left_on)
+    right = right.dropna(subset=[right_on]).astype({right_on: 'float64'}).sort_values(right_on)
+    res = pd.merge_asof(left, right, left_on=left_on, right_on=right_on, by=by,
+                        direction=direction, allow_exact_matches=allow_exact_matches,
+                        tolerance=tolerance)
+    return res.dropna(subset=[right_on]).reset_index(drop=True)
+
+def within_window(left, right, left_on, right_on, start, end, by='d_person_id'):
+    """join each left row to every right row of the same `by` with
+    start <= right_on - left_on <= end, e.g. start=-29, end=29 for the
+    events within 30 days (exclusive) of an index date in days.
+
+    The right rows are sorted once by (by, date), then the window of each left
+    row is found by a binary search, so the cost grows with the number of
+    rows and matches, not with the pairs of events per person.
+    """
+    left = left.dropna(subset=[left_on])
+    right = right.dropna(subset=[right_on])
+    codes, _ = pd.factorize(pd.concat([left[by], right[by]], ignore_index=True))
+    left_code, right_code = codes[:len(left)], codes[len(left):]
+    left_date = left[left_on].to_numpy(dtype='float64')
+    right_date = right[right_on].to_numpy(dtype='float64')
+
+    # one sortable key per (person, date), the windows never cross persons
+    dates = np.concatenate([left_date, right_date])
+    low = dates.min() if len(dates) else 0
+    span = (dates.max() - low if len(dates) else 0) + abs(start) + abs(end) + 1
+    left_key = left_code * span + (left_date - low)
+    right_key = right_code * span + (right_date - low)
+    order = np.argsort(right_key, kind='stable')
+    right_key = right_key[order]
+
+    lo = np.searchsorted(right_key, left_key + start, side='left')
+    hi = np.searchsorted(right_key, left_key + end, side='right')
+    n = hi - lo
+    left_index = np.repeat(np.arange(len(left)), n)
+    right_index = order[np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)]
+
+    right = right.drop(columns=by)
+    right = right.rename(columns={c: f'{c}_right' for c in right.columns if c in left.columns})
+    return pd.concat([left.iloc[left_index].reset_index(drop=True),
+                      right.iloc[right_index].reset_index(drop=True)], axis=1)